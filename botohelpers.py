@@ -3,8 +3,115 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import boto.s3.connection
+import threading
+import time
+from boto.exception import S3ResponseError
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+from urlparse import urlparse
 from util import Singleton
 
 
 class S3Connection(Singleton, boto.s3.connection.S3Connection):
-    pass
+    def __init__(self, endpoint=None, **kwargs):
+        # Allow to point to a local S3 stand-in with e.g.
+        # endpoint='http://localhost:4569'.
+        if endpoint:
+            url = urlparse(endpoint)
+            kwargs.setdefault('host', url.hostname)
+            kwargs.setdefault('port', url.port)
+            kwargs.setdefault('is_secure', url.scheme == 'https')
+            kwargs.setdefault('calling_format',
+                boto.s3.connection.OrdinaryCallingFormat())
+        boto.s3.connection.S3Connection.__init__(self, **kwargs)
+
+
+class S3Uploader(object):
+    '''Uploads files to an S3 bucket.
+
+    Keys are expected to be content-addressed, so files are not uploaded
+    again when the key already exists. Large files are sent with a multipart
+    upload, with parts uploaded in parallel and retried individually.
+    '''
+    # S3 requires parts of at least 5MB, except for the last one.
+    PART_SIZE = 8 * 1024 * 1024
+    CONCURRENCY = 4
+    RETRIES = 5
+
+    def __init__(self, bucket, part_size=PART_SIZE, concurrency=CONCURRENCY,
+            retries=RETRIES):
+        self._bucket = bucket
+        self._part_size = part_size
+        self._concurrency = concurrency
+        self._retries = retries
+
+    def upload(self, path, fh, headers=None):
+        '''Upload the contents of the given file object under the given key.
+        Returns whether an upload actually happened.'''
+        if self._exists(path):
+            return False
+
+        fh.seek(0, 2)
+        size = fh.tell()
+        fh.seek(0)
+        if size <= self._part_size:
+            key = self._bucket.new_key(path)
+            self._retry(key.set_contents_from_file, fh, headers=headers,
+                rewind=True)
+        else:
+            self._multipart_upload(path, fh, size, headers)
+        return True
+
+    def _exists(self, path):
+        try:
+            return self._retry(self._bucket.get_key, path) is not None
+        except S3ResponseError as e:
+            # Without s3:ListBucket, S3 denies access to missing keys instead
+            # of reporting them missing. Uploading only needs s3:PutObject.
+            if e.status == 403:
+                return False
+            raise
+
+    def _multipart_upload(self, path, fh, size, headers):
+        upload = self._retry(self._bucket.initiate_multipart_upload, path,
+            headers=headers)
+        lock = threading.Lock()
+
+        def upload_part(part_num):
+            offset = (part_num - 1) * self._part_size
+            with lock:
+                fh.seek(offset)
+                data = fh.read(self._part_size)
+            self._retry(self._upload_part, upload, part_num, data)
+
+        parts = range(1, (size + self._part_size - 1) / self._part_size + 1)
+        pool = ThreadPool(min(self._concurrency, len(parts)))
+        try:
+            pool.map(upload_part, parts)
+            self._retry(upload.complete_upload)
+        except:
+            try:
+                upload.cancel_upload()
+            except Exception:
+                pass
+            raise
+        finally:
+            pool.close()
+
+    @staticmethod
+    def _upload_part(upload, part_num, data):
+        upload.upload_part_from_file(StringIO(data), part_num=part_num,
+            size=len(data))
+
+    def _retry(self, func, *args, **kwargs):
+        for retry in range(self._retries):
+            try:
+                return func(*args, **kwargs)
+            except S3ResponseError as e:
+                # Client errors are not going to be fixed by retrying.
+                if e.status < 500 or retry == self._retries - 1:
+                    raise
+            except Exception:
+                if retry == self._retries - 1:
+                    raise
+            time.sleep(2 ** retry)
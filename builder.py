@@ -2,30 +2,64 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import gzip
-import hashlib
+import ccache
+import errno
+import json
+import logging
 import os
 import subprocess
+import threading
 import time
-from botohelpers import S3Connection
-from contextlib import closing
+import traceback
+from botohelpers import (
+    S3Connection,
+    S3Uploader,
+)
+from buildlog import (
+    BuildLog,
+    LiveLog,
+)
+from collections import OrderedDict
+from contextlib import (
+    closing,
+    contextmanager,
+)
+from failure import classify_failure
+from procstat import (
+    ResourceSampler,
+    summarize,
+)
 from pushlog import Pushlog
-from StringIO import StringIO
 from urllib2 import urlopen
-from util  import cached_property
-from worker import Worker
+from util  import (
+    cached_property,
+    PipeQueue,
+)
+from worker import (
+    PulseExchange,
+    Worker,
+)
+from workqueue import WorkQueue
+from mozillapulse.publishers import GenericPublisher
 
 
 BUILD_AREA = '/srv/build'
-# TODO: Use schroot sessions
-WRAPPER_COMMAND = ['schroot', '-c', 'centos', '--']
+CHROOT = 'centos'
 HG_BASE = 'http://hg.mozilla.org/'
+# Repository holding the store shared by all branches in shared store mode.
+HG_SHARED_STORE = os.path.join(BUILD_AREA, 'hg-store')
+PUSHLOG_STATE = os.path.join(BUILD_AREA, 'pushlog.json')
 
 
 class BuilderWorker(Worker):
+    def __init__(self, revision=None):
+        # Status of the last build of each branch.
+        self._last_status = {}
+        Worker.__init__(self, revision)
+
     @cached_property
-    def _branch(self):
-        return self._config.branch
+    def _branches(self):
+        return self._config.branch.split(',')
 
     @cached_property
     def _queue(self):
@@ -33,8 +67,80 @@ class BuilderWorker(Worker):
             pulse = (self._config.pulse_user, self._config.pulse_password)
         else:
             pulse = False
-        return iter(Pushlog({ self._config.branch: self._config.after },
-            pulse=pulse))
+        if len(self._branches) == 1:
+            branches = { self._branches[0]: self._config.after }
+        else:
+            branches = self._branches
+        # The pushlog state, when there is one, supersedes the configured
+        # starting changeset.
+        pushlog = self._pushlog = Pushlog(branches, pulse=pulse,
+            state=PUSHLOG_STATE)
+        # The queue yields lists of pushes. When coalescing, each list holds
+        # all the pushes pending at the time, and only the last one is built,
+        # unless it fails.
+        if self._coalesce:
+            batches = pushlog.batches()
+        else:
+            batches = ([push] for push in pushlog)
+        if self._config.work_queue:
+            return self._work_queue(batches)
+        # When coalescing, the Prefetcher would hold batches formed before
+        # the pushes that arrived while building, and the newest push would
+        # be built late.
+        if self._config.prefetch and not self._coalesce:
+            return Prefetcher(batches, self._prefetch)
+        return batches
+
+    @cached_property
+    def _coalesce(self):
+        if not self._config.coalesce:
+            return False
+        if self._config.work_queue:
+            # The feeder queues pushes as soon as they arrive, so jobs would
+            # only ever hold one push, and the backlog builds up in the
+            # broker, where nothing coalesces it.
+            self._logger.warning('Coalescing is not supported with a work '
+                'queue, ignoring it')
+            return False
+        return True
+
+    def _work_queue(self, batches):
+        # Jobs are shared with other instances through a queue on the pulse
+        # exchange. Only the instance configured with work_queue=feed reads
+        # the pushlog and fills the queue. Prefetching is not used, as it
+        # would hold a job this instance is not building yet.
+        publisher = PulseExchange(GenericPublisher, self._config)
+        queue = WorkQueue(publisher.connection, publisher.exchange,
+            'queue/%s/%s-jobs-%s' % (self._config.pulse_user,
+                self._config.type, '+'.join(sorted(self._branches))),
+            self._branches, prefetch=self._slots)
+        if self._config.work_queue == 'feed':
+            # Pushes are only done for the pushlog once they are queued.
+            queue.feed(batches, published=self._pushlog.done)
+        return queue
+
+    # Number of jobs running concurrently.
+    _slots = 1
+
+    _pushlog = None
+
+    def _job_done(self, pushes):
+        if self._config.work_queue:
+            self._queue.done(pushes)
+        else:
+            self._pushlog.done(pushes)
+
+    def _prefetch(self, pushes):
+        push = pushes[-1]
+        buildlog = BuildLog(dir=BUILD_AREA)
+        builder = Builder(buildlog, None, None, None, None,
+            shared_store=bool(self._config.hg_shared_store))
+        try:
+            builder.prefetch(push['branch'], push['changesets'][-1])
+        except BuildError as e:
+            self._logger.warning('Prefetch failed: %s' % e)
+        finally:
+            buildlog.close()
 
     @cached_property
     def _queue_name(self):
@@ -45,22 +151,7 @@ class BuilderWorker(Worker):
             return
         Worker.shutdown(self)
 
-    def run(self):
-        if not self._running:
-            return
-
-        try:
-            push = self._queue.next()
-        except StopIteration:
-            self.shutdown()
-            return
-
-        changeset = push['changesets'][-1]
-
-        buildlog = BuildLog()
-        status = 'failed'
-        url = ''
-
+    def _get_mozconfig(self):
         mozconfig = self._config.mozconfig
         if self._config.mozconfig:
             if self._config.mozconfig.startswith('http:') or \
@@ -76,7 +167,9 @@ class BuilderWorker(Worker):
                 mozconfig = '. $topsrcdir/%s\n' % self._config.mozconfig
         else:
             mozconfig = '. $topsrcdir/browser/config/mozconfigs/linux64/nightly\n'
+        return mozconfig
 
+    def _get_patch(self):
         patch_url = self._config.patch
         patch=''
         if patch_url:
@@ -86,26 +179,124 @@ class BuilderWorker(Worker):
             except:
                 # TODO: Log some failure cases.
                 pass
+        return patch
+
+    def run(self):
+        if not self._running:
+            return
+
+        try:
+            pushes = self._queue.next()
+        except StopIteration:
+            self.shutdown()
+            return
 
-        builder = Builder(buildlog, mozconfig, patch,
-            self._config.tooltool_manifest, self._config.tooltool_base)
+        try:
+            self._run_job(pushes)
+        finally:
+            self._job_done(pushes)
+
+    def _run_job(self, pushes):
+        buildlog = BuildLog(dir=BUILD_AREA)
+        builder = Builder(buildlog, self._get_mozconfig(), self._get_patch(),
+            self._config.tooltool_manifest, self._config.tooltool_base,
+            shared_store=bool(self._config.hg_shared_store),
+            profile=bool(self._config.profile),
+            # Concurrent jobs share the cache, and its statistics.
+            ccache_stats=self._slots == 1)
+        try:
+            branch = pushes[-1]['branch']
+            status = self._build(builder, buildlog, pushes[-1], pushes)
+            if status != 'success' and len(pushes) > 1:
+                # Bisecting only makes sense when the branch was known to
+                # build before the first push.
+                if self._last_status.get(branch) == 'success':
+                    self._bisect(builder, buildlog, pushes)
+                else:
+                    self._logger.warning('Not bisecting %d pushes on branch '
+                        '%s, which was not known to build before them'
+                        % (len(pushes), branch))
+            self._last_status[branch] = status
+        finally:
+            buildlog.close()
+
+    @staticmethod
+    def _summarize_resources(buildlog):
+        items = [item for item in buildlog if item['resources']]
+        if not items:
+            return None
+        summary = summarize(item['resources'] for item in items)
+        slowest = max(items, key=lambda item: item['duration'])
+        summary['slowest'] = dict(slowest['resources'],
+            command=slowest['command'], duration=slowest['duration'])
+        return summary
+
+    def _job_info(self):
+        '''Extra information about the current job, for events.'''
+        if self._pushlog:
+            return {'pushlog': dict(self._pushlog.stats)}
+        return {}
+
+    def _bisect(self, builder, buildlog, pushes):
+        '''Find the first failing push amongst the given pushes, knowing the
+        last one fails, and the state before the first one was good.'''
+        good, bad = 0, len(pushes) - 1
+        while good < bad:
+            middle = (good + bad) // 2
+            status = self._build(builder, buildlog, pushes[middle],
+                pushes[good:middle + 1], bisect=True)
+            if status == 'success':
+                good = middle + 1
+            else:
+                bad = middle
+        push = pushes[bad]
+        changeset = push['changesets'][-1]
+        self._logger.warning('Push for changeset %s on branch %s is the first '
+            'failing one of %d' % (changeset, push['branch'], len(pushes)),
+            extra={
+                'event': 'bisect',
+                'changeset': changeset,
+                'branch': push['branch'],
+                'pushes': [p['changesets'][-1] for p in pushes],
+            })
+
+    def _build(self, builder, buildlog, push, covers, bisect=False):
+        '''Build the given push, retrying with a clobber on failures a
+        clobber may fix. The result is recorded as covering the given list of
+        pushes, and as bisecting when the push was already built as part of
+        a later one.'''
+        changeset = push['changesets'][-1]
+        branch = push['branch']
+        covers = [p['changesets'][-1] for p in covers]
+        status = 'failed'
+        url = ''
         for clobber in (False, True):
             buildlog.clear()
             started = time.time()
+            buildlog.live = LiveLog(self._log_storage, 'live/%s/%s/%d/'
+                % (self._config.instanceId, changeset, started))
             self._logger.warning(
                 'Starting job for changeset %s on branch %s (wait: %d + %d)'
-                % (changeset, self._branch, int(push['received'] - push['date']),
-                   int(started - push['received'])), extra={
+                % (changeset, branch, int(push['received'] - push['date']),
+                   int(started - push['received'])),
+                extra=dict(self._job_info(), **{
                     'event': 'start',
                     'changeset': changeset,
-                    'branch': self._branch,
+                    'branch': branch,
                     'clobber': clobber,
+                    'bisect': bisect,
                     'pushed': push['date'],
                     'received': push['received'],
-                })
+                    'started': started,
+                    # Time between the push notification and the start of
+                    # the job.
+                    'latency': started - push['received'],
+                    'livelog': buildlog.live.prefix,
+                    'pushes': covers,
+                }))
             try:
                 builder.build(
-                    branch=self._branch,
+                    branch=branch,
                     changeset=changeset,
                     clobber=clobber,
                 )
@@ -113,93 +304,236 @@ class BuilderWorker(Worker):
             except BuildError:
                 pass
             finished = time.time()
+            retry = retry_reason = None
+            if status != 'success' and not clobber:
+                retry, retry_reason = classify_failure(buildlog)
+            live = buildlog.live
+            live.close()
+            buildlog.live = None
+            phases = OrderedDict(builder.phases)
+            resources = self._summarize_resources(buildlog)
+            upload_start = time.time()
             try:
                 url = self.store_log(buildlog)
             except:
-                pass
+                import traceback
+                self._logger.error('Failed to store log for changeset %s:\n%s'
+                    % (changeset, traceback.format_exc()))
+            else:
+                # The live copy of the log is not needed anymore.
+                live.remove(url)
+            phases['log upload'] = time.time() - upload_start
             self._logger.warning('Finished job for changeset %s on branch %s (%s)'
-                % (changeset, self._branch, status), extra={
+                % (changeset, branch, status),
+                extra=dict(self._job_info(), **{
                     'event': 'end',
                     'changeset': changeset,
-                    'branch': self._branch,
+                    'branch': branch,
                     'status': status,
                     'buildlog': url,
                     'clobber': clobber,
                     'clobbered': builder.clobbered,
+                    'bisect': bisect,
                     'pushed': push['date'],
                     'received': push['received'],
                     'started': started,
                     'finished': finished,
-                })
-            if status == 'success':
+                    'pushes': covers,
+                    'retry': retry,
+                    'retry_reason': retry_reason,
+                    'ccache': builder.ccache_stats,
+                    'phases': phases,
+                    'resources': resources,
+                }))
+            if status == 'success' or not retry:
                 break
+        return status
 
     @cached_property
     def _log_storage(self):
-        return S3Connection().get_bucket(self._config.type, validate=False)
+        return S3Connection(endpoint=self._config.s3_endpoint).get_bucket(
+            self._config.type, validate=False)
+
+    @cached_property
+    def _log_uploader(self):
+        return S3Uploader(self._log_storage)
 
     def store_log(self, log):
-        data = StringIO()
-        hash = hashlib.sha1()
-        with gzip.GzipFile(mode='w', compresslevel=9, fileobj=data) as fh:
-            log.serialize(HashProxy(fh, hash))
-        hash = hash.hexdigest()
+        hash = log.hexdigest()
         path = 'logs/%s/%s/%s.gz' % (hash[0], hash[1], hash)
-        key = self._log_storage.new_key(path)
-        key.set_contents_from_string(data.getvalue(), headers={
+        if self._log_uploader.upload(path, log.compressed, headers={
             'x-amz-acl': 'public-read',
             'Content-Type': 'text/plain',
             'Content-Encoding': 'gzip',
             'Cache-Control': 'max-age=1296000', # Two weeks
-        })
-
-        data.close()
+        }):
+            key = self._log_storage.new_key(path[:-3] + '.json')
+            key.set_contents_from_string(json.dumps(log.index()), headers={
+                'x-amz-acl': 'public-read',
+                'Content-Type': 'application/json',
+                'Cache-Control': 'max-age=1296000', # Two weeks
+            })
         return path
 
 
-class HashProxy(object):
-    def __init__(self, fh, hash):
-        self._fh = fh
-        self._hash = hash
+class Prefetcher(object):
+    '''Iterator reading ahead from another iterator in a background thread,
+    and calling the given function on each item as soon as it is read, such
+    that e.g. the changesets for the next push can be pulled while the
+    current push is being built.'''
+    # Marks the end of the items in the queue.
+    _END = object()
+
+    def __init__(self, items, prefetch):
+        self._items = items
+        self._prefetch = prefetch
+        self._logger = logging.getLogger('Worker')
+        # Exception raised while reading the items, re-raised by next().
+        self._error = None
+        # Avoid reading too far ahead of the push being consumed.
+        self._queue = PipeQueue(maxsize=1)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            for item in self._items:
+                try:
+                    self._prefetch(item)
+                except Exception:
+                    self._logger.error('Prefetch failed:\n%s'
+                        % traceback.format_exc())
+                self._queue.put(item)
+        except Exception as e:
+            self._logger.error('Failed to read the next item:\n%s'
+                % traceback.format_exc())
+            self._error = e
+        finally:
+            self._queue.put(self._END)
+
+    def __iter__(self):
+        return self
 
-    def write(self, s):
-        self._fh.write(s)
-        self._hash.update(s)
+    def next(self):
+        item = self._queue.get()
+        if item is self._END:
+            # Keep the end marker for subsequent calls.
+            self._queue.put(item)
+            if self._error:
+                raise self._error
+            raise StopIteration
+        return item
 
 
 class BuildError(RuntimeError):
     pass
 
 
+class SchrootSession(object):
+    '''Persistent schroot session in which wrapped commands are run, so
+    that the chroot is only set up and torn down once per build.
+
+    Anything with the same interface can be given to Builder instead.
+    '''
+    def __init__(self, chroot=CHROOT):
+        self._chroot = chroot
+        self._session = None
+
+    def begin(self):
+        assert self._session is None
+        try:
+            self._session = subprocess.check_output(
+                ['schroot', '-b', '-c', self._chroot]).strip()
+        except subprocess.CalledProcessError as e:
+            raise BuildError('Failed to start a schroot session for %s: %s'
+                % (self._chroot, e.output))
+
+    @property
+    def wrapper(self):
+        assert self._session is not None
+        return ['schroot', '-r', '-c', self._session, '--']
+
+    def end(self):
+        if self._session is None:
+            return
+        subprocess.call(['schroot', '-e', '-c', self._session])
+        self._session = None
+
+
 class Builder(object):
     def __init__(self, buildlog, mozconfig, patch, tooltool_manifest,
-            tooltool_base):
+            tooltool_base, session=None, shared_store=False, profile=False,
+            ccache_stats=True):
         self._log = buildlog
         self._mozconfig = mozconfig
         self._patch = patch
         self._tooltool = (tooltool_manifest, tooltool_base) \
             if tooltool_manifest and tooltool_base else None
+        self._session = session or SchrootSession()
+        self._shared_store = shared_store
+        self._profile = profile
+        # Whether to gather ccache statistics, which are only meaningful when
+        # no other build uses the cache at the same time.
+        self._ccache_stats = ccache_stats
         self.clobbered = False
+        self.ccache_stats = None
+        self.phases = OrderedDict()
 
-    def execute(self, command, input=None, cwd=None, wrapper=WRAPPER_COMMAND):
+    def execute(self, command, input=None, cwd=None, wrapper=None):
+        if wrapper is None:
+            wrapper = self._session.wrapper
         start = time.time()
         proc = subprocess.Popen(wrapper + command,
             stdin=subprocess.PIPE if input else None,
             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd)
-        stdout, stderr = proc.communicate(input)
-        assert not stderr
+        if input:
+            # Feed the input from a separate thread so that a command
+            # producing output before having read all of it can't deadlock.
+            feeder = threading.Thread(target=self._feed,
+                args=(proc.stdin, input))
+            feeder.start()
+        sampler = ResourceSampler(proc.pid) if self._profile else None
+        self._log.start(command)
+        self._log.capture(proc.stdout)
+        if input:
+            feeder.join()
+        rusage = None
+        if sampler:
+            # Wait with os.wait4 to get the exact resource usage of the
+            # process and its children.
+            while True:
+                try:
+                    pid, status, rusage = os.wait4(proc.pid, 0)
+                    break
+                except OSError as e:
+                    if e.errno != errno.EINTR:
+                        raise
+            if os.WIFSIGNALED(status):
+                returncode = -os.WTERMSIG(status)
+            else:
+                returncode = os.WEXITSTATUS(status)
+            # The process is reaped, don't let Popen wait for it.
+            proc.returncode = returncode
+        else:
+            returncode = proc.wait()
         end = time.time()
-        self._log.add(
-            command=command,
-            output=stdout,
+        self._log.finish(
             duration=end - start,
-            status=proc.returncode,
+            status=returncode,
+            resources=sampler.stop(rusage) if sampler else None,
         )
-        if proc.returncode:
+        if returncode:
             raise BuildError("Command %s failed" % command)
 
-    def prepare_source(self, branch, changeset, clobber=False):
-        source_dir = os.path.join(BUILD_AREA, os.path.basename(branch))
+    @staticmethod
+    def _feed(fh, input):
+        try:
+            fh.write(input)
+        finally:
+            fh.close()
+
+    def _clone(self, branch, changeset, source_dir):
         clone = not os.path.exists(source_dir)
         if clone:
             clone_branch = 'mozilla-central' if branch == 'try' else branch
@@ -210,33 +544,106 @@ class Builder(object):
             self.execute(hg + ['id', '-i'])
         if not clone or branch == 'try':
             self.execute(hg + ['pull', HG_BASE + branch, '-r', changeset])
-        self.execute(hg + ['update', '-C', '-r', changeset])
+
+    def _share(self, branch, changeset, source_dir):
+        '''Like _clone, but with all branches sharing the same store, such
+        that changesets common to several branches are only pulled once.'''
+        if not os.path.exists(HG_SHARED_STORE):
+            self.execute(['hg', 'clone', '--noupdate',
+                          HG_BASE + 'mozilla-central', HG_SHARED_STORE])
+        if not os.path.exists(os.path.join(source_dir, '.hg', 'sharedpath')):
+            # Remove any full clone from before using the shared store.
+            self.execute(['rm', '-rf', source_dir])
+            self.execute(['hg', '--config', 'extensions.share=', 'share',
+                          '--noupdate', HG_SHARED_STORE, source_dir])
+        else:
+            self.execute(['hg', '-R', source_dir, 'id', '-i'])
+        self.execute(['hg', '-R', HG_SHARED_STORE, 'pull', HG_BASE + branch,
+                      '-r', changeset])
+
+    def prefetch(self, branch, changeset):
+        '''Pull the given changeset into the repository that will be used
+        to build it, without touching its working directory.'''
+        if self._shared_store:
+            repo = HG_SHARED_STORE
+        else:
+            repo = os.path.join(BUILD_AREA, os.path.basename(branch))
+        # Leave the initial clone to prepare_source.
+        if not os.path.exists(repo):
+            return
+        self._session.begin()
+        try:
+            self.execute(['hg', '-R', repo, 'pull', HG_BASE + branch,
+                          '-r', changeset])
+        finally:
+            self._session.end()
+
+    def prepare_source(self, branch, changeset, clobber=False):
+        source_dir = os.path.join(BUILD_AREA, os.path.basename(branch))
+        with self._phase('pull'):
+            if self._shared_store:
+                self._share(branch, changeset, source_dir)
+            else:
+                self._clone(branch, changeset, source_dir)
+        hg = ['hg', '-R', source_dir]
+        with self._phase('update'):
+            self.execute(hg + ['update', '-C', '-r', changeset])
         purge_cmd = hg + ['--config', 'extensions.purge=', 'purge']
         if clobber:
             purge_cmd.append('--all')
-        self.execute(purge_cmd)
+        with self._phase('purge'):
+            self.execute(purge_cmd)
         if self._patch:
-            self.execute(['patch', '-d', source_dir, '-p1'], self._patch,
-                wrapper=[])
-        if self._tooltool:
-            tooltool_path = os.path.join(os.path.dirname(__file__), 'tooltool',
-                'tooltool.py')
-            manifest_path = os.path.join(source_dir, self._tooltool[0])
-            self.execute(['cat', manifest_path])
-            self.execute(['python', tooltool_path, '--url', self._tooltool[1],
-                '-m', manifest_path, '--overwrite',
-                '-c', os.path.join(BUILD_AREA, 'tooltool'),
-                'fetch'], cwd=source_dir, wrapper=[])
-            if os.path.exists(os.path.join(source_dir, 'setup.sh')):
-                self.execute(['bash', '-xe', 'setup.sh'], cwd=source_dir,
+            with self._phase('patch'):
+                self.execute(['patch', '-d', source_dir, '-p1'], self._patch,
                     wrapper=[])
+        if self._tooltool:
+            with self._phase('tooltool'):
+                self._fetch_tooltool(source_dir)
         return source_dir
 
+    def _fetch_tooltool(self, source_dir):
+        tooltool_path = os.path.join(os.path.dirname(__file__), 'tooltool',
+            'tooltool.py')
+        manifest_path = os.path.join(source_dir, self._tooltool[0])
+        self.execute(['cat', manifest_path])
+        self.execute(['python', tooltool_path, '--url', self._tooltool[1],
+            '-m', manifest_path, '--overwrite',
+            '-c', os.path.join(BUILD_AREA, 'tooltool'),
+            'fetch'], cwd=source_dir, wrapper=[])
+        if os.path.exists(os.path.join(source_dir, 'setup.sh')):
+            self.execute(['bash', '-xe', 'setup.sh'], cwd=source_dir,
+                wrapper=[])
+
+    @contextmanager
+    def _phase(self, name):
+        '''Account the time spent in the context to the given build phase.'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - start
+
     def build(self, branch, changeset, clobber=False):
+        self.ccache_stats = None
+        self.phases = OrderedDict()
+        with self._phase('session'):
+            self._session.begin()
+        try:
+            self._build(branch, changeset, clobber)
+        finally:
+            with self._phase('session'):
+                self._session.end()
+
+    def _build(self, branch, changeset, clobber):
         # Add some entropy to the log
         self.execute(['date'])
-        self.execute(
-            ['env', 'CCACHE_DIR=/srv/cache', 'ccache', '-z', '-M', '10G'])
+        with self._phase('ccache'):
+            # Don't zero the statistics, in case other builds are using the
+            # cache.
+            self.execute(
+                ['env', 'CCACHE_DIR=/srv/cache', 'ccache', '-M', '10G'])
+            ccache_before = self._get_ccache_stats()
         source_dir = self.prepare_source(branch, changeset, clobber=clobber)
         obj_dir = os.path.join(BUILD_AREA, 'obj-' + os.path.basename(branch))
         mozconfig = os.path.join(source_dir, '.mozconfig')
@@ -246,13 +653,30 @@ class Builder(object):
             fh.write('mk_add_options MOZ_OBJDIR=%s\n' % obj_dir)
         self.execute(['cat', mozconfig])
         if clobber:
-            self.execute(['rm', '-rf', obj_dir])
+            with self._phase('clobber'):
+                self.execute(['rm', '-rf', obj_dir])
         self.clobbered = clobber or self.will_clobber(obj_dir, source_dir)
         try:
-            self.execute(['env', 'CCACHE_DIR=/srv/cache', 'make', '-f',
-                'client.mk', '-C', source_dir])
+            # Configure separately, so that its time can be told apart from
+            # the compilation's.
+            with self._phase('configure'):
+                self.execute(['env', 'CCACHE_DIR=/srv/cache', 'make', '-f',
+                    'client.mk', '-C', source_dir, 'configure'])
+            with self._phase('compile'):
+                self.execute(['env', 'CCACHE_DIR=/srv/cache', 'make', '-f',
+                    'client.mk', '-C', source_dir])
         finally:
-            self.execute(['env', 'CCACHE_DIR=/srv/cache', 'ccache', '-s'])
+            with self._phase('ccache'):
+                ccache_after = self._get_ccache_stats()
+            if ccache_before and ccache_after:
+                self.ccache_stats = ccache.diff_stats(ccache_before,
+                                                      ccache_after)
+
+    def _get_ccache_stats(self):
+        if not self._ccache_stats:
+            return None
+        self.execute(['env', 'CCACHE_DIR=/srv/cache', 'ccache', '-s'])
+        return ccache.parse_stats(self._log.output(list(self._log)[-1]))
 
     def will_clobber(self, obj_dir, src_dir):
         """Returns a bool indicating whether a tree clobber is going to be performed."""
@@ -269,36 +693,3 @@ class Builder(object):
             return False
 
         return True
-
-
-class BuildLog(object):
-    def __init__(self):
-        self.clear()
-
-    def add(self, **kwargs):
-        assert set(kwargs.keys()) == \
-            set(['command', 'output', 'duration', 'status'])
-        self._data.append(kwargs)
-
-    def clear(self):
-        self._data = []
-
-    def _serialize_one(self, item):
-        command, output, duration, status = \
-            item['command'], item['output'], item['duration'], item['status']
-
-        return ''.join([
-            '===== Started %s\n' % command,
-            output,
-            '===== %s %s in %d:%02d\n' % (
-                'Failed (status: %d)' % (status) if status else 'Finished',
-                command,
-                duration / 60,
-                duration % 60,
-            ),
-        ])
-
-    def serialize(self, fh):
-        for item in self._data:
-            fh.write(self._serialize_one(item))
-            fh.write('\n')
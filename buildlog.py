@@ -0,0 +1,285 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import errno
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
+from pgzip import ParallelGzipWriter
+
+
+class HashProxy(object):
+    def __init__(self, fh, hash):
+        self._fh = fh
+        self._hash = hash
+
+    def write(self, s):
+        self._fh.write(s)
+        self._hash.update(s)
+
+
+class BuildLog(object):
+    '''Log of the commands executed during a build.
+
+    Command output is appended to a temporary file as it is produced, and
+    only offsets and metadata are kept in memory, so that memory usage stays
+    flat regardless of how much output a build produces.
+
+    The serialized log is also gzipped (in parallel) and hashed as it is
+    produced, so that the compressed log and its SHA-1 are ready as soon as
+    the build ends.
+    The compressor is fully flushed around each command, so that the output
+    of each command can be decompressed on its own from a byte range of the
+    gzipped log given in the index.
+    '''
+    CHUNK_SIZE = 64 * 1024
+    COMPRESS_LEVEL = 9
+
+    def __init__(self, dir=None):
+        self._fh = tempfile.TemporaryFile(prefix='buildlog', dir=dir)
+        self._compressed = tempfile.TemporaryFile(prefix='buildlog',
+            suffix='.gz', dir=dir)
+        self._gzip = None
+        self._pool = ThreadPool(multiprocessing.cpu_count())
+        # Optional LiveLog receiving everything that is written to the log.
+        self.live = None
+        self.clear()
+
+    def add(self, **kwargs):
+        assert set(kwargs.keys()) == \
+            set(['command', 'output', 'duration', 'status'])
+        self.start(kwargs['command'])
+        self.write(kwargs['output'])
+        self.finish(kwargs['duration'], kwargs['status'])
+
+    def start(self, command):
+        assert self._current is None
+        self._gzip.flush(zlib.Z_FULL_FLUSH)
+        gz_offset = self._compressed.tell()
+        self._write('===== Started %s\n' % command)
+        self._current = {
+            'command': command,
+            'offset': self._fh.tell(),
+            'gz_offset': gz_offset,
+        }
+
+    def write(self, data):
+        assert self._current is not None
+        self._write(data)
+
+    def capture(self, fh):
+        '''Append everything that can be read from the given file object to
+        the output of the current command. Output is appended as soon as it
+        is available, so that it reaches the live log early.'''
+        while True:
+            # File objects' read() waits for the whole chunk.
+            try:
+                data = os.read(fh.fileno(), self.CHUNK_SIZE)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not data:
+                break
+            self.write(data)
+
+    def finish(self, duration, status, resources=None):
+        item = self._current
+        item['length'] = self._fh.tell() - item['offset']
+        item['duration'] = duration
+        item['status'] = status
+        item['resources'] = resources
+        self._write('===== %s %s in %d:%02d\n\n' % (
+            'Failed (status: %d)' % (status) if status else 'Finished',
+            item['command'],
+            duration / 60,
+            duration % 60,
+        ))
+        self._gzip.flush(zlib.Z_FULL_FLUSH)
+        item['gz_length'] = self._compressed.tell() - item['gz_offset']
+        self._data.append(item)
+        self._current = None
+
+    def _write(self, data):
+        self._fh.write(data)
+        self._sink.write(data)
+        if self.live:
+            self.live.write(data)
+
+    def clear(self):
+        self._data = []
+        self._current = None
+        self._fh.seek(0)
+        self._fh.truncate()
+        if self._gzip:
+            self._gzip.close()
+        self._compressed.seek(0)
+        self._compressed.truncate()
+        self._gzip = ParallelGzipWriter(self._compressed,
+            self.COMPRESS_LEVEL, pool=self._pool)
+        self._hash = hashlib.sha1()
+        self._sink = HashProxy(self._gzip, self._hash)
+
+    def close(self):
+        self._gzip.close()
+        self._pool.close()
+        self._compressed.close()
+        self._fh.close()
+
+    def finalize(self):
+        '''Finish the compressed log. No command may be added afterwards.'''
+        assert self._current is None
+        if not self._gzip.closed:
+            self._gzip.close()
+            self._compressed.flush()
+
+    def hexdigest(self):
+        '''Return the SHA-1 of the uncompressed log.'''
+        return self._hash.hexdigest()
+
+    @property
+    def compressed(self):
+        '''Return a file object containing the gzipped log.'''
+        self.finalize()
+        self._compressed.seek(0)
+        return self._compressed
+
+    def index(self):
+        '''Return the index of the commands in the log, with the byte range
+        of each of them in the gzipped log.'''
+        return [{
+            'command': item['command'],
+            'status': item['status'],
+            'duration': item['duration'],
+            'resources': item['resources'],
+            'offset': item['gz_offset'],
+            'length': item['gz_length'],
+        } for item in self._data]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def output(self, item, tail=None):
+        '''Return the output of the given command as recorded in the log.
+        When tail is given, only return that many bytes from the end of the
+        output.'''
+        offset, length = item['offset'], item['length']
+        if tail is not None and length > tail:
+            offset += length - tail
+            length = tail
+        self._fh.seek(offset)
+        data = self._fh.read(length)
+        self._fh.seek(0, 2)
+        return data
+
+    def serialize(self, fh):
+        self._fh.flush()
+        self._fh.seek(0)
+        while True:
+            data = self._fh.read(self.CHUNK_SIZE)
+            if not data:
+                break
+            fh.write(data)
+        self._fh.seek(0, 2)
+
+
+def read_section(key, item):
+    '''Return the part of the log corresponding to the given index item,
+    reading only the corresponding byte range of the given S3 key.'''
+    data = key.get_contents_as_string(headers={
+        'Range': 'bytes=%d-%d' % (item['offset'],
+                                  item['offset'] + item['length'] - 1),
+    })
+    return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
+
+
+class LiveLog(object):
+    '''Publishes a log to S3 while it is being written, so that it can be
+    followed during the build.
+
+    Every few seconds, the data written since the last flush is stored as
+    <prefix><sequence number>. An empty <prefix>end key is stored when the
+    log is complete. Once the complete log is stored elsewhere, remove()
+    deletes the chunks and leaves the path to the complete log in the end
+    key. The end keys are small, and can be expired with an S3 lifecycle
+    rule on the live/ prefix.
+    '''
+    INTERVAL = 5
+    RETRIES = 3
+
+    def __init__(self, bucket, prefix, interval=INTERVAL):
+        self._bucket = bucket
+        self._prefix = prefix
+        self._interval = interval
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._sequence = 0
+        self._logger = logging.getLogger('LiveLog')
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def prefix(self):
+        return self._prefix
+
+    def write(self, data):
+        with self._lock:
+            self._buffer.append(data)
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+
+    def remove(self, path):
+        '''Delete the chunks of the closed log, which is now stored
+        completely at the given path.'''
+        self._put('end', path)
+        chunks = [self._prefix + '%08d' % n for n in range(self._sequence)]
+        if not chunks:
+            return
+        try:
+            self._bucket.delete_keys(chunks, quiet=True)
+        except Exception as e:
+            self._logger.error('Failed to delete %s chunks: %s'
+                % (self._prefix, e))
+
+    def _run(self):
+        while not self._closed.wait(self._interval):
+            self._flush()
+        self._flush()
+        self._put('end', '')
+
+    def _flush(self):
+        with self._lock:
+            data = ''.join(self._buffer)
+            self._buffer = []
+        if not data:
+            return
+        # Followers list the keys, so a chunk that fails to be stored is only
+        # a gap in the live log, and the sequence number still needs to move
+        # forward.
+        self._put('%08d' % self._sequence, data)
+        self._sequence += 1
+
+    def _put(self, name, data):
+        path = self._prefix + name
+        for retry in range(self.RETRIES):
+            try:
+                key = self._bucket.new_key(path)
+                key.set_contents_from_string(data, headers={
+                    'x-amz-acl': 'public-read',
+                    'Content-Type': 'text/plain',
+                    'Cache-Control': 'no-cache',
+                })
+                return
+            except Exception as e:
+                error = e
+        self._logger.error('Failed to store %s: %s' % (path, error))
@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import re
+
+
+# Counters for compiler calls ccache can't cache.
+UNCACHEABLE = set([
+    'called for link',
+    'called for preprocessing',
+    'multiple source files',
+    'compiler produced stdout',
+    'compiler produced no output',
+    'compiler produced empty output',
+    'compile failed',
+    'ccache internal error',
+    'preprocessor error',
+    'can\'t use precompiled header',
+    'couldn\'t find the compiler',
+    'cache file missing',
+    'bad compiler arguments',
+    'unsupported source language',
+    'compiler check failed',
+    'autoconf compile/link',
+    'unsupported compiler option',
+    'output to stdout',
+    'output to a non-regular file',
+    'no input file',
+    'error hashing extra file',
+])
+
+SIZE_UNITS = {
+    'kB': 1000,
+    'MB': 1000 ** 2,
+    'GB': 1000 ** 3,
+    'TB': 1000 ** 4,
+    # Older versions of ccache.
+    'Kbytes': 1024,
+    'Mbytes': 1024 ** 2,
+    'Gbytes': 1024 ** 3,
+}
+
+LINE_RE = re.compile(r'^(.*?)\s{2,}(\S.*)$')
+SIZE_RE = re.compile(r'^([\d.]+) (\w+)$')
+
+
+def parse_size(value):
+    match = SIZE_RE.match(value)
+    if not match or match.group(2) not in SIZE_UNITS:
+        return None
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def parse_stats(output):
+    '''Parse the output of `ccache -s` into a dict with the number of hits
+    and misses, the hit rate, the number of calls that couldn't be cached,
+    the number of cleanups (evictions) and the cache size.'''
+    counters = {}
+    for line in output.splitlines():
+        match = LINE_RE.match(line.strip())
+        if match:
+            counters[match.group(1).strip()] = match.group(2).strip()
+
+    def count(name):
+        value = counters.get(name, '0')
+        return int(value) if value.isdigit() else 0
+
+    hits = count('cache hit (direct)') + count('cache hit (preprocessed)')
+    misses = count('cache miss')
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': float(hits) / (hits + misses) if hits + misses else None,
+        'uncacheable': sum(count(name) for name in UNCACHEABLE),
+        'cleanups': count('cleanups performed'),
+        'files': count('files in cache'),
+        'size': parse_size(counters.get('cache size', '')),
+        'max_size': parse_size(counters.get('max cache size', '')),
+    }
+
+
+def diff_stats(before, after):
+    '''Return the statistics for what happened between the two given
+    results of parse_stats, without having to zero the counters.'''
+    result = dict(after)
+    for name in ('hits', 'misses', 'uncacheable', 'cleanups'):
+        result[name] = after[name] - before[name]
+    calls = result['hits'] + result['misses']
+    result['hit_rate'] = float(result['hits']) / calls if calls else None
+    return result
@@ -13,7 +13,9 @@ from util import (
 class Config(Singleton):
     _slots = set(['instanceId', 'max_idle', 'region', 'type', 'branch',
         'after', 'mozconfig', 'patch', 'tooltool_manifest',
-        'tooltool_base', 'pulse_user', 'pulse_password'])
+        'tooltool_base', 'pulse_user', 'pulse_password', 's3_endpoint',
+        'hg_shared_store', 'prefetch', 'coalesce', 'work_queue', 'profile',
+        'log_queue_size', 'log_spill'])
 
     def __getattr__(self, name):
         if name not in Config._slots:
@@ -63,4 +65,4 @@ class Config(Singleton):
 
     @property
     def _defaults(self):
-        return { 'max_idle': 1800 }
+        return { 'max_idle': 1800, 'prefetch': 1 }
@@ -0,0 +1,68 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import re
+
+
+# Only look at the end of the build output, where errors end up.
+TAIL_SIZE = 4 * 1024 * 1024
+
+# Failures that a clobber build is likely to fix.
+CLOBBER_FAILURES = [
+    (re.compile(r'The CLOBBER file has been updated'), 'clobber requested'),
+    (re.compile(r'No rule to make target'), 'missing dependency'),
+    (re.compile(r'\.deps/\S+\.pp:\d+: \*\*\*'), 'stale dependency file'),
+    # Only when the missing file, or the file including it, is in the objdir
+    # or dist/. Other missing headers are most likely a source problem.
+    (re.compile(r'(?:/obj-[^/\s]+/|\bdist/)\S*:\d+:(?:\d+:)? fatal error: '
+                r'\S+: No such file or directory|'
+                r'fatal error: \S*(?:/obj-[^/\s]+/|\bdist/)\S*: '
+                r'No such file or directory'),
+        'missing generated file'),
+    (re.compile(r'config\.status: error'), 'stale configuration'),
+    (re.compile(r'file format not recognized|File truncated'),
+        'corrupted object file'),
+]
+
+# Failures a clobber build is not going to fix.
+SOURCE_FAILURES = [
+    (re.compile(r'^\S+:\d+:(?:\d+:)? error: ', re.M), 'compiler error'),
+    (re.compile(r'^error(?:\[E\d+\])?: ', re.M), 'rust compiler error'),
+    (re.compile(r'fatal error: \S+: No such file or directory'),
+        'missing header'),
+    (re.compile(r'undefined reference to'), 'link error'),
+    (re.compile(r'^configure: error: ', re.M), 'configure error'),
+    (re.compile(r'^(?:SyntaxError|\w+Error): ', re.M), 'python error'),
+]
+
+
+def classify_failure(buildlog):
+    '''Classify the failure in the given build log. Returns a tuple
+    (clobber, reason), where clobber is whether a clobber build is worth
+    trying.'''
+    failed = [item for item in buildlog if item['status']]
+    if not failed:
+        return True, 'unknown failure'
+    # Later failures, if any, are from commands run after the build failed.
+    item = failed[0]
+    command = item['command']
+    if 'make' not in command:
+        # e.g. hg pull or update hitting a network error. Retrying is cheap
+        # compared to losing the build.
+        return True, 'command failed before the build: %s' % ' '.join(command)
+
+    output = buildlog.output(item, tail=TAIL_SIZE)
+    for failures, clobber in ((CLOBBER_FAILURES, True),
+                              (SOURCE_FAILURES, False)):
+        for pattern, reason in failures:
+            match = pattern.search(output)
+            if match:
+                line_start = output.rfind('\n', 0, match.start()) + 1
+                line_end = output.find('\n', match.end())
+                if line_end == -1:
+                    line_end = len(output)
+                return clobber, '%s: %s' % (reason,
+                    output[line_start:line_end].strip())
+    # When in doubt, try a clobber build, like we always used to.
+    return True, 'unknown failure'
@@ -0,0 +1,201 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import sqlite3
+import sys
+import time
+
+
+def percentile(values, p):
+    '''Nearest-rank percentile of the given sorted values.'''
+    if not values:
+        return None
+    rank = max(0, int(round(p / 100.0 * len(values))) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def median(values):
+    return percentile(sorted(values), 50)
+
+
+class BuildHistory(object):
+    '''Store of the 'end' events of builds, in a SQLite database.'''
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS builds (
+            instance TEXT,
+            branch TEXT,
+            changeset TEXT,
+            status TEXT,
+            clobber INTEGER,
+            clobbered INTEGER,
+            pushed REAL,
+            received REAL,
+            started REAL,
+            finished REAL,
+            buildlog TEXT,
+            bisect INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS builds_branch
+            ON builds (branch, finished);
+        CREATE INDEX IF NOT EXISTS builds_instance
+            ON builds (instance, finished);
+    '''
+    COLUMNS = ('instance', 'branch', 'changeset', 'status', 'clobber',
+        'clobbered', 'pushed', 'received', 'started', 'finished', 'buildlog',
+        'bisect')
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        self._db.executescript(self.SCHEMA)
+        # Databases created before builds were flagged as bisecting.
+        columns = [row[1] for row in
+                   self._db.execute('PRAGMA table_info(builds)')]
+        if 'bisect' not in columns:
+            with self._db:
+                self._db.execute('ALTER TABLE builds ADD COLUMN bisect INTEGER')
+
+    def record(self, data):
+        '''Record the given log message data if it is an 'end' event.'''
+        self.record_many([data])
+
+    def record_many(self, items):
+        '''Record the 'end' events amongst the given log message data, in a
+        single transaction.'''
+        rows = [[dict(data, instance=data.get('instanceId')).get(c)
+                 for c in self.COLUMNS]
+                for data in items if data.get('event') == 'end']
+        if not rows:
+            return
+        with self._db:
+            self._db.executemany('INSERT INTO builds (%s) VALUES (%s)' % (
+                ', '.join(self.COLUMNS), ', '.join('?' for c in self.COLUMNS)),
+                rows)
+
+    def _builds(self, since, where='', args=()):
+        cursor = self._db.execute(
+            'SELECT %s FROM builds WHERE finished >= ? %s ORDER BY started'
+            % (', '.join(self.COLUMNS), where), (since,) + tuple(args))
+        for row in cursor:
+            yield dict(zip(self.COLUMNS, row))
+
+    def stats(self, since, group_by='branch'):
+        '''Return statistics about the builds finished since the given time,
+        grouped by branch or instance.'''
+        assert group_by in ('branch', 'instance')
+        groups = {}
+        for build in self._builds(since):
+            groups.setdefault(build[group_by], []).append(build)
+
+        result = {}
+        for group, builds in groups.items():
+            # Builds retried with a clobber, and bisecting builds, are not
+            # for new pushes.
+            first = [b for b in builds if not b['clobber'] and not b['bisect']]
+            # The outcome of a push is that of its last build, e.g. the
+            # retry with a clobber.
+            outcomes = {}
+            for b in builds:
+                if not b['bisect']:
+                    outcomes[b['branch'], b['changeset']] = b['status']
+            waits = sorted(b['started'] - b['pushed'] for b in first
+                           if b['started'] and b['pushed'])
+            # Time between the push notification and the start of the
+            # build.
+            pickups = sorted(b['started'] - b['received'] for b in first
+                             if b['started'] and b['received'])
+            durations = sorted(b['finished'] - b['started'] for b in builds
+                               if b['finished'] and b['started'])
+            result[group] = {
+                'builds': len(builds),
+                'success_rate': sum(1 for status in outcomes.values()
+                    if status == 'success') / float(len(outcomes))
+                    if outcomes else None,
+                'clobber_rate': sum(1 for b in builds
+                    if b['clobber'] or b['clobbered']) / float(len(builds)),
+                'wait': dict(('p%d' % p, percentile(waits, p))
+                             for p in (50, 90, 99)),
+                'pickup': dict(('p%d' % p, percentile(pickups, p))
+                               for p in (50, 90, 99)),
+                'duration': dict(('p%d' % p, percentile(durations, p))
+                                 for p in (50, 90, 99)),
+            }
+        return result
+
+    def regressions(self, since, threshold=1.25, window=5):
+        '''Return the successful incremental builds finished since the given
+        time that took more than threshold times the median duration of the
+        previous builds on the same branch.'''
+        previous = {}
+        result = []
+        for build in self._builds(since,
+                'AND status = ? AND NOT clobber AND NOT clobbered',
+                ('success',)):
+            duration = build['finished'] - build['started']
+            history = previous.setdefault(build['branch'], [])
+            if len(history) >= window:
+                reference = median(history[-window:])
+                if duration > reference * threshold:
+                    result.append(dict(build, duration=duration,
+                                       reference=reference))
+            history.append(duration)
+        return result
+
+
+def format_duration(value):
+    if value is None:
+        return '-'
+    return '%d:%02d' % (value / 60, value % 60)
+
+
+def format_rate(value):
+    if value is None:
+        return '-'
+    return '%.1f%%' % (value * 100)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='Show statistics from a build history database')
+    parser.add_argument('database', help='Path to the database')
+    parser.add_argument('--since', type=float, default=24,
+        help='Time window, in hours (default: 24)')
+    parser.add_argument('--by', choices=('branch', 'instance'),
+        default='branch', help='How to group statistics')
+    parser.add_argument('--regressions', action='store_true',
+        help='Show build time regressions between changesets')
+    parser.add_argument('--threshold', type=float, default=1.25,
+        help='Build time ratio considered a regression (default: 1.25)')
+    args = parser.parse_args(args)
+
+    history = BuildHistory(args.database)
+    since = time.time() - args.since * 3600
+
+    if args.regressions:
+        for build in history.regressions(since, threshold=args.threshold):
+            print('%s %s on %s: %s (median before: %s)' % (
+                time.strftime('%Y-%m-%d %H:%M:%S',
+                              time.localtime(build['started'])),
+                build['changeset'], build['branch'],
+                format_duration(build['duration']),
+                format_duration(build['reference'])))
+        return 0
+
+    print('%-30s %6s %8s %8s %10s %10s %10s %10s %10s' % (args.by,
+        'builds', 'success', 'clobber', 'wait p50', 'wait p90',
+        'pickup p90', 'build p50', 'build p90'))
+    for group, stats in sorted(history.stats(since, args.by).items()):
+        print('%-30s %6d %8s %7.1f%% %10s %10s %10s %10s %10s' % (group,
+            stats['builds'], format_rate(stats['success_rate']),
+            stats['clobber_rate'] * 100,
+            format_duration(stats['wait']['p50']),
+            format_duration(stats['wait']['p90']),
+            format_duration(stats['pickup']['p90']),
+            format_duration(stats['duration']['p50']),
+            format_duration(stats['duration']['p90'])))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -2,27 +2,135 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import argparse
+import calendar
+import datetime
+import json
 import logging
+import os
+import re
 import sys
+import threading
 import time
+import traceback
+from boto.exception import S3ResponseError
+from botohelpers import S3Connection
+from buildlog import read_section
 from config import Config
+from history import BuildHistory
+from Queue import (
+    Empty,
+    Queue,
+)
 from util import cached_property
 from worker import Worker
+import pytz
 from dateutil.parser import parse as dateparse
+from mozillapulse.config import PulseConfiguration
+
+# Dates in pulse messages' _meta.sent, as produced by mozillapulse's rfc3339
+# module, e.g. 2015-03-04T12:34:56+01:00.
+RFC3339_RE = re.compile(r'(\d{4})-(\d\d)-(\d\d)[Tt ](\d\d):(\d\d):(\d\d)'
+                        r'(?:\.(\d+))?(?:([Zz])|([+-])(\d\d):?(\d\d))?$')
+
+BROKER_TIMEZONE = pytz.timezone(
+    PulseConfiguration.defaults['broker_timezone'])
+
+
+_broker_offsets = {}
+
+
+def broker_offsets(fields):
+    '''Return the DST and UTC offsets, in seconds, of the given local time
+    in the broker timezone.'''
+    # Offsets only change on the hour.
+    hour = tuple(fields[:4])
+    if hour not in _broker_offsets:
+        if len(_broker_offsets) > 1000:
+            _broker_offsets.clear()
+        date = BROKER_TIMEZONE.localize(datetime.datetime(*hour))
+        _broker_offsets[hour] = (int(date.dst().total_seconds()),
+                                 int(date.utcoffset().total_seconds()))
+    return _broker_offsets[hour]
+
+
+def parse_timestamp(value):
+    '''Return the POSIX timestamp corresponding to the given date, keeping
+    sub-second precision. Dates without a timezone are considered local.
+
+    mozillapulse gives dates in the broker timezone with the DST offset
+    instead of the UTC offset while DST is in effect, which is corrected.
+
+    >>> parse_timestamp('2026-10-16T14:17:34+01:00')
+    1792185454.0
+    >>> parse_timestamp('2026-10-16T14:17:34-07:00')
+    1792185454.0
+    >>> parse_timestamp('2026-12-16T14:17:34-08:00')
+    1797459454.0
+    >>> parse_timestamp('2026-10-16T21:17:34.25Z')
+    1792185454.25
+    >>> parse_timestamp('Fri, 16 Oct 2026 14:17:34 +0100')
+    1792185454.0
+    '''
+    match = RFC3339_RE.match(value)
+    if match:
+        (year, month, day, hour, minute, second, fraction, utc, sign,
+         offset_hours, offset_minutes) = match.groups()
+        fields = (int(year), int(month), int(day), int(hour), int(minute),
+                  int(second))
+        fraction = float('0.' + fraction) if fraction else 0.0
+        offset = None
+        if utc:
+            offset = 0
+        elif sign:
+            offset = int(offset_hours) * 3600 + int(offset_minutes) * 60
+            if sign == '-':
+                offset = -offset
+    else:
+        date = dateparse(value)
+        fields = date.timetuple()[:6]
+        fraction = date.microsecond / 1000000.0
+        offset = None
+        if date.tzinfo:
+            offset = int(date.utcoffset().total_seconds())
+
+    if offset is None:
+        return time.mktime(fields + (0, 0, -1)) + fraction
+    if offset:
+        dst, utcoffset = broker_offsets(fields)
+        if offset == dst:
+            offset = utcoffset
+    return calendar.timegm(fields + (0, 0, 0)) - offset + fraction
+
 
 class Formatter(logging.Formatter):
+    def __init__(self):
+        logging.Formatter.__init__(self)
+        # Consecutive records are likely to be from the same second.
+        self._asctime = (None, None)
+
     def format(self, record):
-        if hasattr(record, 'instanceId'):
+        record.message = record.getMessage()
+        return self.format_dict(record.__dict__)
+
+    def format_dict(self, data):
+        '''Format the given dict, with the same items as a LogRecord's
+        __dict__ after getMessage().'''
+        if 'instanceId' in data:
             fmt = '%(asctime)s (%(instanceId)s) %(levelname)s:%(name)s:%(message)s'
-            if hasattr(record, 'buildlog') and record.buildlog:
+            if data.get('buildlog'):
                 fmt += '\n   %(buildlog)s'
         else:
             fmt = '%(asctime)s %(levelname)s:%(name)s:%(message)s'
-        record.message = record.getMessage()
-        record.asctime = time.strftime('%Y-%m-%d %H:%M:%S',
-                                       self.converter(record.created))
-        return fmt % record.__dict__
-        
+        second = int(data['created'])
+        cached_second, asctime = self._asctime
+        if second != cached_second:
+            asctime = time.strftime('%Y-%m-%d %H:%M:%S',
+                                    self.converter(second))
+            self._asctime = (second, asctime)
+        data['asctime'] = asctime
+        return fmt % data
+
 
 handler = logging.StreamHandler()
 handler.setFormatter(Formatter())
@@ -30,10 +138,34 @@ logging.getLogger('').addHandler(handler)
 
 
 class LogTailWorker(Worker):
+    '''Worker showing the log messages published by other workers.
+
+    Messages are handed over to a background thread, which handles all the
+    messages received in the meanwhile at once: build history updates go in
+    a single transaction, and formatted records in a single write.
+    '''
     MAPPING = {
         'level': 'levelname',
-        'message': 'msg',
     }
+    BATCH_SIZE = 500
+
+    def __init__(self, events=None, branches=None, instances=None,
+            history=None, record=None):
+        self._history = history
+        self._record = record
+        self._pending = Queue()
+        # Only subscribe to the log messages matching the given filters.
+        self._topics = [
+            'log.%s.%s.%s' % (event, branch.replace('.', '_'),
+                              instance.replace('.', '_'))
+            for event in events or ['*']
+            for branch in branches or ['*']
+            for instance in instances or ['*']
+        ]
+        Worker.__init__(self)
+        self._thread = threading.Thread(target=self._handle_loop)
+        self._thread.daemon = True
+        self._thread.start()
 
     @cached_property
     def _queue_name(self):
@@ -41,26 +173,184 @@ class LogTailWorker(Worker):
 
     def _handle_message(self, data, msg):
         msg.ack()
-        body = data['payload']
-        record = {}
+        self._pending.put(data)
+
+    def _handle_loop(self):
+        # SQLite connections can only be used from the thread creating them.
+        history = BuildHistory(self._history) if self._history else None
+        record = open(self._record, 'a') if self._record else None
+        while True:
+            batch = [self._pending.get()]
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except Empty:
+                    break
+            try:
+                if record:
+                    record.write(''.join(json.dumps(data) + '\n'
+                                         for data in batch))
+                    record.flush()
+                if history:
+                    history.record_many(data['payload'] for data in batch)
+                self._write(self.format_messages(batch, handler.formatter))
+            except Exception:
+                self._logger.error(traceback.format_exc())
+
+    @classmethod
+    def format_messages(cls, messages, formatter):
+        '''Return the formatted log records for the given pulse messages.'''
+        lines = []
+        for data in messages:
+            try:
+                record = dict(data['payload'])
+                for key, logging_key in cls.MAPPING.items():
+                    record[logging_key] = record.pop(key)
+                record['created'] = parse_timestamp(data['_meta']['sent'])
+                lines.append(formatter.format_dict(record))
+            except Exception as e:
+                # Don't let one malformed message drop the others.
+                logging.getLogger('LogTailWorker').error(
+                    'Malformed message (%s): %s' % (e, json.dumps(data)))
+        return lines
+
+    @staticmethod
+    def _write(lines, out=handler):
+        out.acquire()
+        try:
+            stream = out.stream
+            text = u'\n'.join(lines) + u'\n'
+            stream.write(text.encode(
+                getattr(stream, 'encoding', None) or 'utf-8', 'replace'))
+            out.flush()
+        finally:
+            out.release()
+
+
+def follow(bucket, instance, changeset, out=sys.stdout, interval=2):
+    '''Follow the live log of the latest build of the given changeset on the
+    given instance.'''
+    prefix = 'live/%s/%s/' % (instance, changeset)
+    builds = sorted(p.name for p in bucket.list(prefix, delimiter='/'))
+    if not builds:
+        raise Exception('No live log for changeset %s on instance %s'
+            % (changeset, instance))
+    prefix = builds[-1]
+
+    seen = set()
+    while True:
+        keys = sorted(bucket.list(prefix), key=lambda k: k.name)
+        end = None
+        for key in keys:
+            name = key.name[len(prefix):]
+            if name == 'end':
+                end = key
+            elif name not in seen:
+                try:
+                    out.write(key.get_contents_as_string())
+                except S3ResponseError as e:
+                    # Chunks are removed once the complete log is stored.
+                    if e.status != 404:
+                        raise
+                    break
+                out.flush()
+                seen.add(name)
+        if end:
+            path = end.get_contents_as_string()
+            if path:
+                out.write('\nComplete log: %s\n' % path)
+            break
+        time.sleep(interval)
+
 
-        for key, logging_key in self.MAPPING.items():
-            record[logging_key] = body[key]
+def show_failures(bucket, path, out=sys.stdout):
+    '''Show the output of the failed commands in the given build log, only
+    downloading the corresponding parts of it.'''
+    key = bucket.get_key(path)
+    index = json.loads(bucket.get_key(path[:-3] + '.json')
+        .get_contents_as_string())
+    for item in index:
+        if item['status']:
+            out.write(read_section(key, item))
 
-        for key, value in body.items():
-            if key not in self.MAPPING:
-                record[key] = body[key]
 
-        record['created'] = \
-            time.mktime(dateparse(data['_meta']['sent']).timetuple())
-        record['levelno'] = getattr(logging, record['levelname'])
-        rec = logging.makeLogRecord(record)
-        self._logger.handle(rec)
+def benchmark(path):
+    '''Compare handling the pulse messages recorded in the given file one by
+    one, through the logging module, and in batches.'''
+    with open(path) as fh:
+        messages = [json.loads(line) for line in fh]
+    print('Replaying %d messages' % len(messages))
+    out = open(os.devnull, 'w')
+
+    def run(name, func):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        print('%-24s %7.2fs %9.0f messages/s' % (name, elapsed,
+            len(messages) / elapsed))
+
+    def one_by_one():
+        single = logging.StreamHandler(out)
+        single.setFormatter(Formatter())
+        for data in messages:
+            record = dict(data['payload'])
+            record['levelname'] = record.pop('level')
+            record['msg'] = record.pop('message')
+            record['created'] = \
+                time.mktime(dateparse(data['_meta']['sent']).timetuple())
+            record['levelno'] = getattr(logging, record['levelname'])
+            single.handle(logging.makeLogRecord(record))
+
+    def batched():
+        batch = logging.StreamHandler(out)
+        formatter = Formatter()
+        size = LogTailWorker.BATCH_SIZE
+        for i in range(0, len(messages), size):
+            LogTailWorker._write(LogTailWorker.format_messages(
+                messages[i:i + size], formatter), batch)
+
+    run('one by one', one_by_one)
+    run('batched (%d)' % LogTailWorker.BATCH_SIZE, batched)
 
 
 def main(args):
-    Config().max_idle = 0
-    worker = LogTailWorker()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--follow', nargs=2, metavar=('INSTANCE', 'CHANGESET'),
+        help='Follow the log of a running build')
+    parser.add_argument('--failures', metavar='BUILDLOG',
+        help='Show the output of the failed commands in the given build log')
+    parser.add_argument('--event', action='append',
+        help='Only show log messages for the given event (e.g. start, end)')
+    parser.add_argument('--branch', action='append',
+        help='Only show log messages for the given branch')
+    parser.add_argument('--instance', action='append',
+        help='Only show log messages from the given instance')
+    parser.add_argument('--history', metavar='DATABASE',
+        help='Record builds in the given database, for use with history.py')
+    parser.add_argument('--record', metavar='FILE',
+        help='Append the received messages to the given file')
+    parser.add_argument('--replay', metavar='FILE',
+        help='Benchmark the handling of the messages recorded in the given '
+             'file')
+    args = parser.parse_args(args)
+
+    if args.replay:
+        benchmark(args.replay)
+        return 0
+
+    config = Config()
+    if args.follow or args.failures:
+        bucket = S3Connection(endpoint=config.s3_endpoint).get_bucket(
+            config.type, validate=False)
+        if args.follow:
+            follow(bucket, *args.follow)
+        else:
+            show_failures(bucket, args.failures)
+        return 0
+
+    config.max_idle = 0
+    worker = LogTailWorker(events=args.event, branches=args.branch,
+        instances=args.instance, history=args.history, record=args.record)
     while True:
         worker.run()
     return 0
@@ -0,0 +1,183 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import gzip
+import multiprocessing
+import random
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+
+def compress_block(data, level):
+    '''Compress the given data as a sequence of raw deflate blocks, ending
+    on a byte boundary and without a final block, such that the result can
+    be concatenated with other such sequences.'''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FULL_FLUSH)
+
+
+class ParallelGzipWriter(object):
+    '''Write-only gzip file object compressing blocks of data in parallel.
+
+    Like pigz, data is split in blocks that are compressed independently
+    on a thread pool (zlib releases the GIL while compressing), and the
+    compressed blocks are concatenated into a single gzip member.
+
+    flush() ends the current block and waits for all pending blocks to be
+    written out, after which the compressed data for anything written
+    afterwards can be decompressed on its own with a raw inflate.
+    '''
+    BLOCK_SIZE = 512 * 1024
+
+    def __init__(self, fileobj, compresslevel=9, pool=None,
+            block_size=BLOCK_SIZE):
+        self._fileobj = fileobj
+        self._level = compresslevel
+        self._own_pool = pool is None
+        self._pool = pool or ThreadPool(multiprocessing.cpu_count())
+        # Bound the amount of data waiting to be written out.
+        self._max_pending = 2 * multiprocessing.cpu_count()
+        self._block_size = block_size
+        self._buffer = []
+        self._buffered = 0
+        self._pending = deque()
+        self._crc = zlib.crc32('')
+        self._size = 0
+        self._fileobj.write('\x1f\x8b\x08\x00%s\x02\xff'
+            % struct.pack('<I', int(time.time())))
+
+    @property
+    def closed(self):
+        return self._fileobj is None
+
+    def write(self, data):
+        if not data:
+            return
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._block_size:
+            self._submit()
+            self._write_ready()
+
+    def _submit(self):
+        if not self._buffered:
+            return
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._pending.append(
+            self._pool.apply_async(compress_block, (data, self._level)))
+
+    def _write_ready(self):
+        while self._pending and (self._pending[0].ready() or
+                len(self._pending) > self._max_pending):
+            self._fileobj.write(self._pending.popleft().get())
+
+    def flush(self, zlib_mode=zlib.Z_FULL_FLUSH):
+        self._submit()
+        while self._pending:
+            self._fileobj.write(self._pending.popleft().get())
+        self._fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        # Empty final block, and gzip trailer.
+        self._fileobj.write('\x03\x00')
+        self._fileobj.write(struct.pack('<II', self._crc & 0xffffffff,
+                                        self._size & 0xffffffff))
+        self._fileobj.flush()
+        self._fileobj = None
+        if self._own_pool:
+            self._pool.close()
+
+
+def synthetic_log(size, seed=42):
+    '''Generate a fake build log of approximately the given size.'''
+    rnd = random.Random(seed)
+    dirs = ['dom/base', 'js/src/jit', 'layout/generic', 'netwerk/protocol/http',
+            'gfx/layers', 'media/libvpx', 'toolkit/components/places',
+            'security/nss/lib/ssl', 'xpcom/threads', 'widget/gtk']
+    flags = ' '.join('-D%s=%d' % (n, rnd.randint(0, 1)) for n in
+        ('MOZILLA_CLIENT', 'NDEBUG', 'TRIMMED', 'MOZ_GLUE_IN_PROGRAM',
+         'IMPL_LIBXUL', 'STATIC_EXPORTABLE_JS_API'))
+    chunks = []
+    total = 0
+    while total < size:
+        lines = []
+        for i in range(1000):
+            d = rnd.choice(dirs)
+            name = 'Unified_cpp_%s%d' % (d.replace('/', '_'),
+                rnd.randint(0, 50))
+            kind = rnd.random()
+            if kind < 0.7:
+                line = ('/usr/bin/ccache /tools/gcc/bin/c++ -o %s.o -c %s '
+                        '-I/srv/build/src/%s -include mozilla-config.h '
+                        '-MD -MP -MF .deps/%s.o.pp /srv/build/src/%s/%s.cpp\n'
+                        % (name, flags, d, name, d, name))
+            elif kind < 0.9:
+                line = '%s.cpp\n' % name
+            else:
+                line = ('/srv/build/src/%s/%s.cpp:%d:%d: warning: unused '
+                        'variable \'rv%d\' [-Wunused-variable]\n'
+                        % (d, name, rnd.randint(1, 5000), rnd.randint(1, 80),
+                           rnd.randint(0, 100)))
+            lines.append(line)
+        chunk = ''.join(lines)
+        chunks.append(chunk)
+        total += len(chunk)
+    return chunks
+
+
+def benchmark(size, workers, level=9):
+    chunks = synthetic_log(size)
+    total = sum(len(c) for c in chunks)
+    print('Synthetic log: %d bytes' % total)
+
+    def run(name, make_writer):
+        with tempfile.TemporaryFile() as out:
+            start = time.time()
+            writer = make_writer(out)
+            for chunk in chunks:
+                writer.write(chunk)
+            writer.close()
+            elapsed = time.time() - start
+            out.seek(0)
+            compressed = len(out.read())
+        print('%-24s %7.2fs %7.1f MB/s  ratio %.3f' % (name, elapsed,
+            total / elapsed / 1024 / 1024, float(compressed) / total))
+
+    run('gzip.GzipFile', lambda out: gzip.GzipFile(filename='', mode='wb',
+        compresslevel=level, fileobj=out))
+    pool = ThreadPool(workers)
+    run('ParallelGzipWriter (%d)' % workers,
+        lambda out: ParallelGzipWriter(out, level, pool=pool))
+    pool.close()
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='Compare gzip.GzipFile and ParallelGzipWriter on a '
+                    'synthetic build log')
+    parser.add_argument('--size', type=int, default=500,
+        help='Size of the synthetic log, in MB (default: 500)')
+    parser.add_argument('--workers', type=int,
+        default=multiprocessing.cpu_count(),
+        help='Number of compression threads (default: number of cores)')
+    args = parser.parse_args(args)
+    benchmark(args.size * 1024 * 1024, args.workers)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
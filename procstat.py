@@ -0,0 +1,138 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import threading
+import time
+
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def read_processes():
+    '''Return a dict mapping pids to their parent pid, cpu time (including
+    waited-for children, in seconds) and resident set size (in bytes).'''
+    processes = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % pid) as fh:
+                stat = fh.read()
+        except IOError:
+            continue
+        # The command name may contain spaces and parens.
+        fields = stat[stat.rindex(')') + 2:].split()
+        processes[int(pid)] = (
+            int(fields[1]),
+            sum(int(f) for f in fields[11:15]) / float(CLOCK_TICKS),
+            int(fields[21]) * PAGE_SIZE,
+        )
+    return processes
+
+
+def read_io(pid):
+    '''Return the bytes read from and written to disk by the given process
+    and its waited-for children.'''
+    try:
+        with open('/proc/%d/io' % pid) as fh:
+            io = dict(line.split(': ') for line in fh.read().splitlines())
+        return int(io['read_bytes']), int(io['write_bytes'])
+    except (IOError, KeyError, ValueError):
+        return 0, 0
+
+
+class ResourceSampler(object):
+    '''Samples the resources used by a process and its descendants from
+    /proc, in a background thread, until stop() is called.
+
+    Resources of exited processes are accounted in their parent, so sums
+    over the process tree only grow, except for the resident set size.
+    '''
+    INTERVAL = 1
+
+    def __init__(self, pid, interval=INTERVAL):
+        self._pid = pid
+        self._interval = interval
+        self._start = time.time()
+        self._cpu_time = 0
+        self._peak_rss = 0
+        self._read_bytes = 0
+        self._write_bytes = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._sample()
+            if self._stopped.wait(self._interval):
+                break
+
+    def _sample(self):
+        processes = read_processes()
+        children = {}
+        for pid, (ppid, cpu_time, rss) in processes.items():
+            children.setdefault(ppid, []).append(pid)
+        tree = []
+        pending = [self._pid]
+        while pending:
+            pid = pending.pop()
+            if pid in processes:
+                tree.append(pid)
+                pending.extend(children.get(pid, []))
+        if not tree:
+            return
+        self._cpu_time = max(self._cpu_time,
+            sum(processes[pid][1] for pid in tree))
+        self._peak_rss = max(self._peak_rss,
+            sum(processes[pid][2] for pid in tree))
+        io = [read_io(pid) for pid in tree]
+        self._read_bytes = max(self._read_bytes, sum(r for r, w in io))
+        self._write_bytes = max(self._write_bytes, sum(w for r, w in io))
+
+    def stop(self, rusage=None):
+        '''Stop sampling and return the resources used. When given, the
+        resource usage of the process as returned by os.wait4 completes the
+        samples, which miss the last interval.'''
+        self._stopped.set()
+        self._thread.join()
+        self._sample()
+        if rusage:
+            self._cpu_time = max(self._cpu_time,
+                rusage.ru_utime + rusage.ru_stime)
+            # ru_maxrss is in kilobytes, and only covers the largest process.
+            self._peak_rss = max(self._peak_rss, rusage.ru_maxrss * 1024)
+            # Blocks are 512 bytes.
+            self._read_bytes = max(self._read_bytes, rusage.ru_inblock * 512)
+            self._write_bytes = max(self._write_bytes,
+                rusage.ru_oublock * 512)
+        elapsed = time.time() - self._start
+        return {
+            'cpu_time': self._cpu_time,
+            'elapsed': elapsed,
+            # Average number of cores used.
+            'cpu_utilization': self._cpu_time / elapsed if elapsed else 0,
+            'peak_rss': self._peak_rss,
+            'read_bytes': self._read_bytes,
+            'write_bytes': self._write_bytes,
+        }
+
+
+def summarize(resources):
+    '''Summarize the resources used by several commands.'''
+    resources = [r for r in resources if r]
+    if not resources:
+        return None
+    cpu_time = sum(r['cpu_time'] for r in resources)
+    elapsed = sum(r.get('elapsed', 0) for r in resources)
+    return {
+        'cpu_time': cpu_time,
+        'cpu_utilization': cpu_time / elapsed if elapsed else 0,
+        'peak_rss': max(r['peak_rss'] for r in resources),
+        'read_bytes': sum(r['read_bytes'] for r in resources),
+        'write_bytes': sum(r['write_bytes'] for r in resources),
+    }
@@ -3,21 +3,87 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
+import heapq
+import httplib
 import json
+import logging
+import os
+import random
 import re
 import time
 import socket
+import tempfile
 import threading
 from collections import OrderedDict
-from contextlib import closing
 from kombu import Exchange
 from mozillapulse import consumers
-from urllib2 import urlopen
-from Queue import Queue, Empty
+from multiprocessing.pool import ThreadPool
+from urllib import urlencode
+from util import PipeQueue
+from Queue import Empty
+
+
+HG_HOST = 'hg.mozilla.org'
+
+
+class HTTPError(Exception):
+    def __init__(self, status, reason):
+        Exception.__init__(self, '%d %s' % (status, reason))
+        self.status = status
+
+    @property
+    def retryable(self):
+        # Server errors and throttling are usually transient, while other
+        # client errors are not going to be fixed by retrying.
+        return self.status >= 500 or self.status == 429
+
+
+class ConnectionPool(object):
+    '''Pool of keep-alive HTTPS connections to a given host, such that
+    consecutive requests don't each pay for a TCP and TLS handshake.'''
+    def __init__(self, host, timeout=60):
+        self._host = host
+        self._timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        '''Return the body of the response to a GET request for the given
+        path, raising HTTPError if the status is not 200.'''
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            reused = conn is not None
+            if not reused:
+                conn = httplib.HTTPSConnection(self._host,
+                    timeout=self._timeout)
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # The server may have closed the idle connection in the
+                # meanwhile. Retry with a new one.
+                if reused:
+                    continue
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                with self._lock:
+                    self._idle.append(conn)
+            if response.status != 200:
+                raise HTTPError(response.status, response.reason)
+            return body
 
 
 class PulseListener(object):
     instance = None
+    # The listener thread only needs to wake up to notice shutdowns, which
+    # also wake up iterators directly.
+    DRAIN_TIMEOUT = 60
+    RECONNECT_DELAY = 5
 
     def __init__(self, filter_callback, auth=()):
         assert isinstance(auth, tuple)
@@ -35,8 +101,9 @@ class PulseListener(object):
             self.applabel = str(datetime.now())
 
 
-        self.queue = Queue()
+        self.queue = PipeQueue()
         self.listener_thread = threading.Thread(target=self.pulse_listener)
+        self.listener_thread.daemon = True
         self.listener_thread.start()
 
     def pulse_listener(self):
@@ -90,6 +157,13 @@ class PulseListener(object):
             if self._filter(data):
                 self.queue.put(data)
 
+        try:
+            self._listen(got_message)
+        finally:
+            # Wake up iterators.
+            self.queue.put(None)
+
+    def _listen(self, got_message):
         user, password = self._auth
         while not self.shutting_down:
             # Connect to pulse
@@ -109,6 +183,7 @@ class PulseListener(object):
                 consumer = pulse.connection.Consumer(queue, auto_declare=False,
                     callbacks=[pulse.callback])
             except socket.error:
+                time.sleep(self.RECONNECT_DELAY)
                 continue
             consumer.queues[0].queue_declare()
             # Bind to the first key.
@@ -117,7 +192,8 @@ class PulseListener(object):
             with consumer:
                 while not self.shutting_down:
                     try:
-                        pulse.connection.drain_events(timeout=1)
+                        pulse.connection.drain_events(
+                            timeout=self.DRAIN_TIMEOUT)
                     except socket.timeout:
                         pass
                     except Exception as e:
@@ -130,32 +206,69 @@ class PulseListener(object):
     def shutdown(self):
         if not self.shutting_down:
             self.shutting_down = True
-            self.listener_thread.join()
+            # Wake up iterators. The listener thread stops on its own after
+            # at most DRAIN_TIMEOUT.
+            self.queue.put(None)
 
-    def _iter(self, timeout, pending_only=False):
-        while True:
+    def _iter(self, timeout=None):
+        while not self.shutting_down:
             try:
-                yield self.queue.get(timeout=timeout)
-            except Empty as e:
-                if not self.listener_thread.is_alive():
-                    self.shutdown()
-                if pending_only or self.shutting_down:
-                    break
+                if timeout is None:
+                    data = self.queue.get()
+                elif timeout > 0:
+                    data = self.queue.get(timeout=timeout)
+                else:
+                    data = self.queue.get(block=False)
+            except Empty:
+                break
             except KeyboardInterrupt:
                 self.shutdown()
                 raise
+            # The listener thread stopped, or shutdown() was called.
+            if data is None:
+                self.shutdown()
+                break
+            yield data
 
     def __iter__(self):
-        for d in self._iter(timeout=1):
-            yield d
+        return self._iter()
 
-    def iter_pending(self):
-        for d in self._iter(timeout=0, pending_only=True):
-            yield d
+    def iter_pending(self, timeout=0):
+        '''Iterate over the pending notifications, waiting at most the given
+        timeout for each one.'''
+        return self._iter(timeout=timeout)
 
 
 class Pushlog(object):
-    def __init__(self, branches, pulse=False):
+    '''Iterator over the pushes on the given branches, starting after the
+    given changesets.
+
+    When a state file is given, the last changeset seen on each branch, and
+    the pushes that were yielded but not marked as done, or fetched but not
+    yielded yet, are saved there, and a new Pushlog with the same state file
+    resumes where the previous one left off.
+    '''
+    RETRIES = 5
+    # Base and maximum delay between retries, in seconds.
+    BACKOFF = 1
+    MAX_BACKOFF = 60
+    # Number of branches fetched concurrently when catching up.
+    CONCURRENCY = 8
+    # Number of pushes fetched at once when catching up.
+    PAGE_SIZE = 100
+    # Number of changesets for which the push is remembered.
+    REV_CACHE_SIZE = 10000
+    # Time to wait after a pulse notification for the next one, which is
+    # likely for another changeset of the same push, in seconds.
+    COALESCE_WINDOW = 1
+    # Maximum time to wait for more notifications, so that a steady stream of
+    # them doesn't hold back the first one, in seconds.
+    COALESCE_MAX_WAIT = 10
+
+    _connections = ConnectionPool(HG_HOST)
+    _logger = logging.getLogger('Pushlog')
+
+    def __init__(self, branches, pulse=False, state=None):
         assert isinstance(branches, (list, dict))
         # Normalize branches.
         if isinstance(branches, list):
@@ -166,8 +279,106 @@ class Pushlog(object):
                 assert isinstance(v, (str, unicode)) or v is None
                 self.branches[b] = v
         self._pulse = pulse
+        # (branch, changeset) -> last changeset of the push, least recently
+        # used first.
+        self._revs = OrderedDict()
+        self.stats = {
+            'notifications': 0,
+            'fetches': 0,
+            'avoided': 0,
+        }
+        self._state = state
+        self._lock = threading.RLock()
+        # Pushes yielded and not done yet, and pushes fetched and not
+        # yielded yet, keyed by (branch, last changeset).
+        self._in_flight = OrderedDict()
+        self._queued = OrderedDict()
+        # Pushes from the state file, yielded first.
+        self._resumed = OrderedDict()
+        if state:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self._state) as fh:
+                data = json.load(fh)
+        except IOError:
+            return
+        except ValueError as e:
+            self._logger.error('Ignoring invalid state file %s: %s'
+                % (self._state, e))
+            return
+        for branch, after in data['branches'].items():
+            if branch in self.branches and after:
+                self.branches[branch] = after
+        for push in data['pending']:
+            if push['branch'] in self.branches:
+                self._resumed[self._key(push)] = push
+                self._remember(push)
+
+    def _save(self):
+        if not self._state:
+            return
+        with self._lock:
+            branches = dict(self.branches)
+            # Queued pushes are not going to be fetched again.
+            for key, push in self._queued.items():
+                if key not in self._resumed:
+                    branches[push['branch']] = push['changesets'][-1]
+            pending = OrderedDict(self._in_flight)
+            pending.update(self._resumed)
+            pending.update(self._queued)
+            data = {
+                'branches': branches,
+                'pending': pending.values(),
+            }
+            # Write to a temporary file and rename it, so that the state
+            # file is always complete.
+            try:
+                fd, path = tempfile.mkstemp(
+                    dir=os.path.dirname(os.path.abspath(self._state)))
+                with os.fdopen(fd, 'w') as fh:
+                    json.dump(data, fh)
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                os.rename(path, self._state)
+            except (IOError, OSError) as e:
+                self._logger.error('Failed to save state to %s: %s'
+                    % (self._state, e))
+
+    @staticmethod
+    def _key(push):
+        return push['branch'], push['changesets'][-1]
+
+    def _start(self, pushes):
+        '''Record the given pushes as being yielded.'''
+        with self._lock:
+            for push in pushes:
+                key = self._key(push)
+                self._queued.pop(key, None)
+                self._in_flight[key] = push
+                # The cursor is already past resumed pushes.
+                if self._resumed.pop(key, None) is None:
+                    self.branches[push['branch']] = push['changesets'][-1]
+            self._save()
+
+    def done(self, pushes):
+        '''Mark the given pushes as handled. Pushes that were yielded but
+        are not marked as handled are yielded again after a restart.'''
+        with self._lock:
+            for push in pushes:
+                self._in_flight.pop(self._key(push), None)
+            self._save()
 
     def __iter__(self):
+        return self._run(self._iter)
+
+    def batches(self):
+        '''Iterate over batches of pushes. Each batch contains all the
+        pending pushes for a given branch at the time it is yielded.'''
+        return self._run(self._batches)
+
+    def _run(self, func):
         if self._pulse:
             pulse = PulseListener(lambda data: data['branch'] in self.branches,
                 auth=self._pulse)
@@ -176,74 +387,252 @@ class Pushlog(object):
                 def __iter__(self):
                     return iter([])
 
-                def iter_pending(self):
+                def iter_pending(self, timeout=0):
                     return iter([])
 
+                def shutdown(self):
+                    pass
+
             pulse = DummyPulse()
 
         try:
-            for push in self._iter(pulse):
-                yield push
+            for item in func(pulse):
+                yield item
         finally:
             pulse.shutdown()
 
+    def _catch_up(self, pulse):
+        '''Iterate over the pushes that happened on all branches since the
+        changesets in self.branches, and those received by pulse in the
+        meanwhile, in date order.
+
+        Pushes are fetched PAGE_SIZE at a time, when needed, such that the
+        first of them can be used without waiting for the entire history.
+        '''
+        def start(item):
+            branch, after = item
+            # Without a starting point, there is nothing to catch up with.
+            if after is None:
+                return branch, None, None, None
+            return (branch,) + self._first_page(branch, after)
+
+        pool = ThreadPool(max(1, min(len(self.branches), self.CONCURRENCY)))
+        try:
+            started = pool.map(start, self.branches.items())
+        finally:
+            pool.close()
+
+        last_ids = {}
+        branches = []
+        for branch, last, end, pushes in started:
+            if pushes is not None:
+                last_ids[branch] = last
+                branches.append(self._paginate(branch, last, end, pushes))
+
+        for date, branch, id, push in heapq.merge(*branches):
+            yield push
+
+        # Pushes received by pulse in the meanwhile, except those that were
+        # part of the pages above.
+        for push in self._fetch(list(pulse.iter_pending())):
+            if push['id'] > last_ids.get(push['branch'], -1):
+                yield push
+
+    def _first_page(self, branch, after):
+        '''Return the ID of the last push on the given branch, and the first
+        page of pushes following the given changeset, as returned by
+        _get_page.'''
+        try:
+            data = self._get_json(branch, required=True, changeset=after,
+                version=2)
+        except HTTPError as e:
+            # json-pushes returns a 404 for unknown changesets, e.g. stripped
+            # ones. Pulse still provides the pushes from now on.
+            if e.status != 404:
+                raise
+            data = {'pushes': {}}
+        if not data['pushes']:
+            self._logger.error('Changeset %s not found on branch %s'
+                % (after, branch))
+            return None, None, None
+        last = data['lastpushid']
+        start = max(int(id) for id in data['pushes'])
+        return (last,) + self._get_page(branch, start, last)
+
+    def _get_page(self, branch, start, last):
+        '''Return the ID of the last push in the page following the push
+        with the given ID on the given branch, and the pushes in that
+        page.'''
+        end = min(start + self.PAGE_SIZE, last)
+        if end <= start:
+            return end, OrderedDict()
+        received = time.time()
+        # Skipping a page would skip its pushes for good, since the cursor
+        # moves past them.
+        data = self._get_json(branch, required=True, startID=start,
+            endID=end, version=2)
+        pushes = self._pushes(branch, data['pushes'])
+        for push in pushes.values():
+            push['received'] = received
+        return end, pushes
+
+    def _paginate(self, branch, last, end, pushes):
+        '''Iterate over the pages of pushes on the given branch up to the
+        push with the given last ID, starting with the given page. Items are
+        tuples suitable for heapq.merge.'''
+        while True:
+            for push in pushes.values():
+                self._remember(push)
+                yield push['date'], branch, push['id'], push
+            if end >= last:
+                break
+            end, pushes = self._get_page(branch, end, last)
+
+    def _fetch(self, notifications):
+        '''Return the pushes for the given pulse notifications, in date
+        order, except those already returned before. Pushes are only fetched
+        once, not once per changeset.'''
+        pushes = []
+        for data in notifications:
+            self.stats['notifications'] += 1
+            key = (data['branch'], data['rev'])
+            if key in self._revs:
+                self._revs[key] = self._revs.pop(key)
+                self.stats['avoided'] += 1
+                continue
+            self.stats['fetches'] += 1
+            for push in self.get_pushes(data['branch'],
+                    changeset=data['rev']).values():
+                push['received'] = data['received']
+                if self._remember(push):
+                    pushes.append(push)
+        if self.stats['avoided']:
+            self._logger.info('Avoided %d out of %d pushlog fetches'
+                % (self.stats['avoided'], self.stats['notifications']))
+        return sorted(pushes, key=lambda p: p['date'])
+
+    def _remember(self, push):
+        '''Remember the changesets from the given push. Returns whether the
+        push was not known already.'''
+        last = push['changesets'][-1]
+        new = (push['branch'], last) not in self._revs
+        for changeset in push['changesets']:
+            self._revs.pop((push['branch'], changeset), None)
+            self._revs[(push['branch'], changeset)] = last
+        while len(self._revs) > self.REV_CACHE_SIZE:
+            self._revs.popitem(last=False)
+        return new
+
+    def _coalesce(self, data, pulse):
+        '''Return the given pulse notification along with those received
+        shortly after it, which are likely for the same push. Stops waiting
+        as soon as no notification arrived for COALESCE_WINDOW, or after
+        COALESCE_MAX_WAIT.'''
+        notifications = [data]
+        deadline = time.time() + self.COALESCE_MAX_WAIT
+        while True:
+            timeout = min(self.COALESCE_WINDOW, deadline - time.time())
+            if timeout <= 0:
+                break
+            for data in pulse.iter_pending(timeout=timeout):
+                notifications.append(data)
+                break
+            else:
+                return notifications
+        # Still take those that are already there.
+        return notifications + list(pulse.iter_pending())
 
     def _iter(self, pulse):
-        pushes = {}
-        for branch, after in self.branches.items():
-            received = time.time()
-            pushes[branch] = self.get_pushes(branch, fromchange=after)
-            for push in pushes[branch].values():
-                push['received'] = received
-
-        for data in pulse.iter_pending():
-            rev = data['rev']
-            branch = data['branch']
-            for rev, push in self.get_pushes(branch, changeset=rev).items():
-                # In the unlikely event the changeset was received by pulse
-                # while reading json from other branches, adjust its received
-                # time.
-                if rev in pushes[branch]:
-                    push['received'] = data['received']
-                else:
-                    pushes[branch][rev] = push
+        for push in sorted(self._resumed.values(), key=lambda p: p['date']):
+            self._start([push])
+            yield push
 
-        for push in sorted((p for b in pushes for p in pushes[b].values()),
-                key=lambda p: p['date']):
+        for push in self._catch_up(pulse):
+            self._start([push])
             yield push
-            self.branches[push['branch']] = push['changesets'][-1]
 
         for data in pulse:
-            rev = data['rev']
-            branch = data['branch']
-            for push in self.get_pushes(branch, changeset=rev).values():
-                push['received'] = data['received']
+            pushes = self._fetch(self._coalesce(data, pulse))
+            with self._lock:
+                for push in pushes:
+                    self._queued[self._key(push)] = push
+            for push in pushes:
+                self._start([push])
                 yield push
-                self.branches[branch] = rev
+
+    def _batches(self, pulse):
+        pending = self._queued
+
+        def queue(pushes):
+            for push in pushes:
+                with self._lock:
+                    pending.setdefault(self._key(push), push)
+
+        queue(sorted(self._resumed.values(), key=lambda p: p['date']))
+        queue(self._catch_up(pulse))
+
+        def add(notifications):
+            queue(self._fetch(notifications))
+
+        while True:
+            add(list(pulse.iter_pending()))
+            if not pending:
+                # Wait for something to happen.
+                for data in pulse:
+                    add(self._coalesce(data, pulse))
+                    break
+                else:
+                    return
+                continue
+
+            branch = next(iter(pending.values()))['branch']
+            batch = [p for p in pending.values() if p['branch'] == branch]
+            self._start(batch)
+            yield batch
+
+    @classmethod
+    def get_pushes(cls, branch, **args):
+        return cls._pushes(branch, cls._get_json(branch, **args) or {})
 
     @staticmethod
-    def get_pushes(branch, **args):
+    def _pushes(branch, data):
+        '''Return the given json-pushes data as an ordered dict of pushes,
+        keyed by their last changeset, in date order.'''
         def push_items_key(item):
             id, push = item
-            return (push['date'], id)
-
-        url = 'https://hg.mozilla.org/%s/json-pushes?%s' % (
-            branch,
-            '&'.join('%s=%s' % (k, v) for k, v in args.items()),
-        )
-        for retry in range(0, 5):
+            return (push['date'], int(id))
+
+        result = OrderedDict()
+        for id, push in sorted(data.items(), key=push_items_key):
+            push['branch'] = branch
+            push['id'] = int(id)
+            result[push['changesets'][-1]] = push
+        return result
+
+    @classmethod
+    def _get_json(cls, branch, required=False, **args):
+        '''Return the json-pushes data for the given arguments, or None if
+        it couldn't be retrieved. When the data is required, transient errors
+        are retried indefinitely, and other errors are raised.'''
+        path = '/%s/json-pushes?%s' % (branch, urlencode(sorted(args.items())))
+        retry = 0
+        while True:
             try:
-                with closing(urlopen(url)) as fh:
-                    result = OrderedDict()
-                    pushes = sorted(json.loads(fh.read()).items(),
-                        key=push_items_key)
-                    for id, push in pushes:
-                        push['branch'] = branch
-                        result[push['changesets'][-1]] = push
-                    return result
-            except:
-                time.sleep(1)
-                continue
-            break
-
-        return {}
+                return json.loads(cls._connections.get(path))
+            except (HTTPError, httplib.HTTPException, socket.error,
+                    ValueError) as e:
+                if isinstance(e, HTTPError) and not e.retryable:
+                    cls._logger.error('Failed to get %s: %s' % (path, e))
+                    if required:
+                        raise
+                    return None
+                retry += 1
+                if retry == cls.RETRIES:
+                    cls._logger.error('Failed to get %s after %d attempts: %s'
+                        % (path, cls.RETRIES, e))
+                    if not required:
+                        return None
+                # Exponential backoff, with full jitter so that instances
+                # failing at the same time don't retry at the same time.
+                time.sleep(random.uniform(0,
+                    min(cls.MAX_BACKOFF, cls.BACKOFF * 2 ** (retry - 1))))
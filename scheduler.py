@@ -0,0 +1,151 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from builder import BuilderWorker
+from util import cached_property
+
+
+def memory_info():
+    '''Return the total and available memory, in bytes.'''
+    info = {}
+    with open('/proc/meminfo') as fh:
+        for line in fh:
+            name, value = line.split(':', 1)
+            info[name] = int(value.split()[0]) * 1024
+    # MemAvailable only exists since Linux 3.14.
+    available = info.get('MemAvailable',
+        info['MemFree'] + info.get('Buffers', 0) + info.get('Cached', 0))
+    return info['MemTotal'], available
+
+
+class SchedulerWorker(BuilderWorker):
+    '''Worker building pushes from several branches concurrently.
+
+    The number of concurrent jobs depends on the number of cores and the
+    amount of memory, and a job only starts when the machine load leaves
+    room for it. Only one job runs at a time for a given branch, since jobs
+    for a branch share source and object directories.
+    '''
+    CORES_PER_JOB = 8
+    MEMORY_PER_JOB = 8 * 1024 * 1024 * 1024
+    ADMISSION_DELAY = 10
+
+    def __init__(self, revision=None):
+        BuilderWorker.__init__(self, revision)
+        self._cores = multiprocessing.cpu_count()
+        self._condition = threading.Condition()
+        self._ready = []
+        self._busy = set()
+        self._completed = 0
+        self._since = time.time()
+        self._local = threading.local()
+        self._logger.warning('Running up to %d concurrent jobs' % self._slots)
+        self._threads = []
+        for slot in range(self._slots):
+            thread = threading.Thread(target=self._run_slot, args=(slot,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    @cached_property
+    def _slots(self):
+        return max(1, min(multiprocessing.cpu_count() / self.CORES_PER_JOB,
+                          memory_info()[0] / self.MEMORY_PER_JOB))
+
+    @cached_property
+    def _max_ready(self):
+        return self._slots + (self._config.prefetch or 0)
+
+    def shutdown(self):
+        if not self._running:
+            return
+        BuilderWorker.shutdown(self)
+        with self._condition:
+            self._condition.notify_all()
+
+    def run(self):
+        # Don't read further from the queue than the slots can take, so that
+        # pushes are not all read, and held, at once when catching up.
+        with self._condition:
+            while self._running and len(self._ready) >= self._max_ready:
+                self._condition.wait()
+        if not self._running:
+            return
+
+        try:
+            pushes = self._queue.next()
+        except StopIteration:
+            self.shutdown()
+            return
+
+        with self._condition:
+            branch = pushes[0]['branch']
+            for ready in self._ready:
+                # When coalescing, merge with pushes for the same branch that
+                # are already waiting, as if they had been read together.
+                if self._coalesce and ready[0]['branch'] == branch:
+                    ready.extend(pushes)
+                    break
+            else:
+                self._ready.append(pushes)
+            self._condition.notify_all()
+
+    def _next_job(self):
+        for pushes in self._ready:
+            if pushes[0]['branch'] not in self._busy:
+                self._ready.remove(pushes)
+                self._busy.add(pushes[0]['branch'])
+                return pushes
+
+    def _run_slot(self, slot):
+        self._local.slot = slot
+        while True:
+            with self._condition:
+                pushes = self._next_job()
+                while pushes is None:
+                    if not self._running:
+                        return
+                    self._condition.wait()
+                    pushes = self._next_job()
+                # Room was made for more jobs to be read.
+                self._condition.notify_all()
+            try:
+                self._admit()
+                self._run_job(pushes)
+            except Exception:
+                self._logger.error(traceback.format_exc())
+            finally:
+                self._job_done(pushes)
+                with self._condition:
+                    self._busy.discard(pushes[0]['branch'])
+                    self._completed += 1
+                    self._condition.notify_all()
+
+    def _admit(self):
+        '''Wait until the machine has enough resources left for a new job.'''
+        while self._running:
+            with self._condition:
+                if len(self._busy) == 1:
+                    return
+            load = os.getloadavg()[0]
+            available = memory_info()[1]
+            if load + self.CORES_PER_JOB <= self._cores and \
+                    available >= self.MEMORY_PER_JOB:
+                return
+            time.sleep(self.ADMISSION_DELAY)
+
+    def _job_info(self):
+        with self._condition:
+            return dict(BuilderWorker._job_info(self), **{
+                'slot': self._local.slot,
+                'running': len(self._busy),
+                # Builds completed per hour since the worker started.
+                'throughput': self._completed * 3600.0 /
+                    (time.time() - self._since),
+            })
@@ -71,6 +71,13 @@ class SelfUpdater(Harness):
             import traceback
             self._logger.error(traceback.format_exc())
 
+    def next_update(self):
+        '''Return the time until the next update check, in seconds.'''
+        if not self._can_update:
+            return self.UPDATE_CHECK_PERIOD
+        return max(1, self._last_update + self.UPDATE_CHECK_PERIOD -
+                   time.time())
+
     def _maybe_update(self):
         if not self._can_update:
             return
@@ -109,6 +116,9 @@ class SelfUpdater(Harness):
             self._logger.warning('No changes to the server. Not restarting.')
             return
         self._logger.warning('Server code changed. Restarting.')
+        # execl doesn't run atexit handlers, so publish pending log records
+        # now.
+        logging.shutdown()
         os.execl(sys.executable, sys.executable, __file__)
 
     def get_modules_mtimes(self):
@@ -132,29 +142,37 @@ def virtualenv_main():
     updater = SelfUpdater()
     worker = None
 
-    # Over-simple main loop.
+    # Simple main loop.
     try:
         while True:
             updater.maybe_update()
             if worker is None:
                 try:
+                    from config import Config
                     from worker import LoggingHandler
                     from builder import BuilderWorker
+                    from scheduler import SchedulerWorker
                     logger = logging.getLogger('Worker')
                     logger.addHandler(LoggingHandler())
-                    worker = BuilderWorker(updater.revision())
+                    if ',' in Config().branch:
+                        worker = SchedulerWorker(updater.revision())
+                    else:
+                        worker = BuilderWorker(updater.revision())
                 except:
                     import traceback
                     logging.getLogger('Server').error(traceback.format_exc())
                     worker = False
 
-            if worker:
+            if worker and worker.running:
+                # Blocks until there is a job, and runs it.
                 worker.run()
-
-            time.sleep(1)
+            else:
+                # Nothing to do until the next update.
+                time.sleep(updater.next_update())
     except:
         if worker:
             worker.shutdown()
+        logging.shutdown()
         raise
 
 
@@ -2,6 +2,16 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import errno
+import fcntl
+import os
+import select
+import time
+from Queue import (
+    Empty,
+    Queue,
+)
+
 
 class SingletonMeta(type):
     def __init__(cls, name, bases, dct):
@@ -27,3 +37,56 @@ class cached_property(object):
         if not hasattr(obj, self._name):
             setattr(obj, self._name, self._func(obj))
         return getattr(obj, self._name)
+
+
+class PipeQueue(Queue):
+    '''Queue whose blocking get() waits for put() on a pipe.
+
+    With Python 2, waiting on a Queue with a timeout wakes up regularly to
+    poll, and waiting without a timeout can't be interrupted, e.g. by
+    KeyboardInterrupt. Waiting in select() on a pipe does neither.
+    '''
+    def __init__(self, maxsize=0):
+        Queue.__init__(self, maxsize)
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def __del__(self):
+        for fd in self._wakeup:
+            os.close(fd)
+
+    def _put(self, item):
+        Queue._put(self, item)
+        try:
+            os.write(self._wakeup[1], '\0')
+        except OSError as e:
+            # When the pipe is full, the reader is going to wake up anyways.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def get(self, block=True, timeout=None):
+        if not block:
+            return Queue.get(self, False)
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            try:
+                return Queue.get(self, False)
+            except Empty:
+                pass
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Empty
+            try:
+                select.select([self._wakeup[0]], [], [], remaining)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+            try:
+                os.read(self._wakeup[0], 4096)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
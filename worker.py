@@ -2,15 +2,31 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import json
 import logging
+import os
+import socket
+import threading
 import time
 from config import Config
+from datetime import datetime
+from kombu import (
+    Exchange,
+    Producer,
+)
+from pytz import timezone
+from Queue import (
+    Empty,
+    Full,
+    Queue,
+)
 from util import cached_property
 
 from mozillapulse.publishers import GenericPublisher
 from mozillapulse.consumers import GenericConsumer
 from mozillapulse.config import PulseConfiguration
 from mozillapulse.messages.base import GenericMessage
+from mozillapulse.utils import time_to_string
 
 
 def PulseExchange(cls, config, **kwargs):
@@ -20,35 +36,193 @@ def PulseExchange(cls, config, **kwargs):
 
 
 class LogMessage(GenericMessage):
-    def __init__(self):
+    '''Log message, with a log.<event>.<branch>.<instanceId> routing key,
+    so that consumers can subscribe to only what they need.'''
+    def __init__(self, event=None, branch=None, instanceId=None):
         super(LogMessage, self).__init__()
         self.routing_parts.append('log')
+        for part in (event, branch, instanceId):
+            # Routing key parts are separated with dots, and can't be empty.
+            self.routing_parts.append(
+                str(part).replace('.', '_') if part else 'none')
 
 
 class LoggingHandler(logging.Handler):
+    '''Logging handler publishing records on the pulse exchange.
+
+    Records are queued in memory and published in batches from a background
+    thread, over a single connection, so that a slow or unavailable broker
+    doesn't block the thread logging. When the queue is full, records are
+    appended to the spill file if one is configured, and published once the
+    queue drains, or dropped otherwise.
+    '''
+    QUEUE_SIZE = 1000
+    BATCH_SIZE = 100
+    RETRY_DELAY = 5
+    FLUSH_TIMEOUT = 30
+
     def __init__(self):
         config = Config()
         self._queue = PulseExchange(GenericPublisher, config)
+        self._producer = None
         self._instanceId = config.instanceId
+        self._spill = config.log_spill
+        self._spill_lock = threading.Lock()
+        self._spilled = False
+        self._dropped = 0
         logging.Handler.__init__(self)
         self._dummy_record = logging.LogRecord('', 0, '', 0, '', (), None)
+        self._pending = Queue(maxsize=config.log_queue_size or self.QUEUE_SIZE)
+        self._publisher = threading.Thread(target=self._publish_loop)
+        self._publisher.daemon = True
+        self._publisher.start()
 
     def emit(self, record):
         if not self._queue:
             return
-        m = LogMessage()
-        m.set_data('level', record.levelname)
-        m.set_data('name', record.name)
-        m.set_data('instanceId', self._instanceId)
-        m.set_data('message', record.msg)
+        data = {
+            'level': record.levelname,
+            'name': record.name,
+            'instanceId': self._instanceId,
+            'message': record.msg,
+        }
         # Record any extra data attached to the record.
         for key, value in record.__dict__.items():
             if key not in self._dummy_record.__dict__:
-                m.set_data(key, value)
-        self._queue.publish(m)
+                data[key] = value
+        try:
+            self._pending.put_nowait(data)
+        except Full:
+            self._overflow(data)
+
+    def _overflow(self, data):
+        if self._spill:
+            try:
+                with self._spill_lock:
+                    with open(self._spill, 'a') as fh:
+                        fh.write(json.dumps(data) + '\n')
+                    self._spilled = True
+                return
+            except Exception:
+                pass
+        self._dropped += 1
+
+    def _unspill(self):
+        '''Queue the records from the spill file.'''
+        with self._spill_lock:
+            if not self._spilled:
+                return
+            self._spilled = False
+            try:
+                with open(self._spill) as fh:
+                    lines = fh.readlines()
+                os.remove(self._spill)
+            except (IOError, OSError):
+                return
+        for line in lines:
+            try:
+                self._pending.put_nowait(json.loads(line))
+            except Full:
+                self._overflow(json.loads(line))
+            except ValueError:
+                pass
+
+    def _publish_loop(self):
+        while True:
+            batch = [self._pending.get()]
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except Empty:
+                    break
+            count = len(batch)
+            if self._dropped:
+                dropped, self._dropped = self._dropped, 0
+                batch.append({
+                    'level': 'WARNING',
+                    'name': 'LoggingHandler',
+                    'instanceId': self._instanceId,
+                    'message': 'Dropped %d log messages' % dropped,
+                })
+            self._publish_batch(batch)
+            for i in range(count):
+                self._pending.task_done()
+            if self._pending.empty():
+                self._unspill()
+
+    def _publish_batch(self, batch):
+        '''Publish the given records with a single producer on the
+        publisher's connection. This is equivalent to GenericPublisher.publish
+        for each record, without creating a producer and declaring the
+        exchange every time. Records are retried on connection errors, and
+        dropped on other errors, which retrying wouldn't fix.'''
+        while batch:
+            try:
+                if not self._producer:
+                    self._queue.connect()
+                    self._producer = Producer(self._queue.connection,
+                        exchange=Exchange(self._queue.exchange, type='topic'))
+                connection = self._queue.connection
+                errors = connection.connection_errors + \
+                    connection.channel_errors + (socket.error,)
+            except Exception:
+                self._reconnect()
+                continue
+            try:
+                while batch:
+                    try:
+                        self._publish(batch[0])
+                    except errors:
+                        raise
+                    except Exception:
+                        # e.g. a record that can't be serialized.
+                        self._dropped += 1
+                    batch.pop(0)
+            except errors:
+                self._reconnect()
+
+    def _reconnect(self):
+        '''Drop the connection, to reconnect later.'''
+        self._producer = None
+        try:
+            self._queue.disconnect()
+        except Exception:
+            pass
+        time.sleep(self.RETRY_DELAY)
+
+    def _publish(self, data):
+        m = LogMessage(data.get('event'), data.get('branch'),
+            data.get('instanceId'))
+        for key, value in data.items():
+            m.set_data(key, value)
+        m._prepare()
+        config = self._queue.config
+        meta = dict(m.metadata, **{
+            'exchange': self._queue.exchange,
+            'routing_key': m.routing_key,
+            'serializer': config.serializer,
+            'sent': time_to_string(
+                datetime.now(timezone(config.broker_timezone))),
+        })
+        self._producer.publish({'payload': m.data, '_meta': meta},
+            routing_key=m.routing_key, serializer=config.serializer)
+
+    def flush(self):
+        '''Wait for the queued records to be published.'''
+        deadline = time.time() + self.FLUSH_TIMEOUT
+        while (self._pending.unfinished_tasks or self._spilled) and \
+                time.time() < deadline:
+            time.sleep(0.1)
+
+    def close(self):
+        self.flush()
+        logging.Handler.close(self)
 
 
 class Worker(object):
+    # Topics to subscribe to on the pulse exchange.
+    _topics = ['#']
+
     def __init__(self, revision=None):
         self._config = Config()
         self._idle_since = time.time()
@@ -69,6 +243,10 @@ class Worker(object):
         return PulseExchange(GenericConsumer, self._config,
             applabel=str(uuid.uuid4()))
 
+    @property
+    def running(self):
+        return self._running
+
     def shutdown(self):
         if not self._running:
             return
@@ -79,5 +257,5 @@ class Worker(object):
         if not self._running:
             return
 
-        self._queue.configure(topic=['#'], callback=self._handle_message)
+        self._queue.configure(topic=self._topics, callback=self._handle_message)
         self._queue.listen()
@@ -0,0 +1,118 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import threading
+import time
+from kombu import (
+    binding,
+    Exchange,
+    Queue,
+)
+
+
+class WorkQueue(object):
+    '''Queue of jobs shared by several instances.
+
+    Jobs are lists of pushes, published on the given exchange with a
+    job.<branch> routing key, and stored in a durable queue consuming the
+    jobs for the given branches. Each job is delivered to a single consumer,
+    and is only acknowledged once done() is called for it, so that the
+    broker delivers it again if the consumer dies before that.
+
+    Iterating a WorkQueue yields jobs. Jobs are acknowledged from the thread
+    iterating, since kombu channels are not thread-safe.
+    '''
+    RETRY_DELAY = 5
+
+    def __init__(self, connection, exchange, name, branches, prefetch=1):
+        self._connection = connection
+        self._exchange = Exchange(exchange, type='topic')
+        self._queue = Queue(name, durable=True, auto_delete=False,
+            bindings=[binding(self._exchange, routing_key='job.%s' % b)
+                      for b in branches])
+        self._prefetch = prefetch
+        self._consumer = None
+        self._lock = threading.Lock()
+        self._messages = {}
+        self._done = []
+        self._logger = logging.getLogger('WorkQueue')
+
+    @staticmethod
+    def _key(pushes):
+        return pushes[-1]['changesets'][-1]
+
+    def put(self, pushes):
+        self._publish(self._connection.Producer(), pushes)
+
+    def _publish(self, producer, pushes):
+        producer.publish(pushes, exchange=self._exchange,
+            routing_key='job.%s' % pushes[-1]['branch'],
+            declare=[self._queue], serializer='json',
+            delivery_mode='persistent', retry=True)
+
+    def feed(self, jobs, published=None):
+        '''Put all the jobs from the given iterable in the queue, from a
+        background thread with its own connection. The given function, if
+        any, is called with each job once it is in the queue. Jobs that
+        can't be queued are retried until they are.'''
+        connection = self._connection.clone()
+
+        def run():
+            producer = connection.Producer()
+            for pushes in jobs:
+                while True:
+                    try:
+                        self._publish(producer, pushes)
+                        break
+                    except Exception as e:
+                        self._logger.error('Failed to queue job for %s: %s'
+                            % (self._key(pushes), e))
+                        time.sleep(self.RETRY_DELAY)
+                if published:
+                    published(pushes)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._consumer is None:
+            self._consumer = self._connection.SimpleQueue(self._queue)
+            self._consumer.consumer.qos(prefetch_count=self._prefetch)
+        while True:
+            self._ack_done()
+            # Wake up regularly to acknowledge jobs done in other threads.
+            try:
+                message = self._consumer.get(timeout=1)
+            except self._consumer.Empty:
+                continue
+            pushes = message.payload
+            with self._lock:
+                self._messages[self._key(pushes)] = message
+            return pushes
+
+    def done(self, pushes):
+        '''Mark the given job as done. It will be acknowledged the next time
+        the queue is iterated. When jobs were merged, all the jobs the given
+        pushes cover are acknowledged.'''
+        with self._lock:
+            self._done.extend(p['changesets'][-1] for p in pushes)
+
+    def _ack_done(self):
+        with self._lock:
+            done, self._done = self._done, []
+            messages = [self._messages.pop(key) for key in done
+                        if key in self._messages]
+        for message in messages:
+            message.ack()
+
+    def close(self):
+        self._ack_done()
+        if self._consumer:
+            self._consumer.close()
+        self._connection.release()